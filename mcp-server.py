@@ -1,23 +1,250 @@
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Callable, Awaitable, Tuple
 from fastmcp import FastMCP
+from fastmcp.server.middleware import Middleware, MiddlewareContext
 from browser_use import Agent, BrowserProfile
 from browser_use.browser import BrowserSession
 from browser_use.llm.openai.chat import ChatOpenAI
-from pydantic import BaseModel, Field, PydanticUserError
+from pydantic import BaseModel, Field, PrivateAttr, PydanticUserError
 from browser_use.llm import ChatAnthropic, ChatAzureOpenAI, ChatGoogle, ChatGroq
 from enum import Enum
 import os
 import random
 import asyncio
 import re
-from playwright.async_api import async_playwright, expect
+import time
+import uuid
+import sys
+import atexit
+import contextlib
+import queue
+import logging
+import contextvars
+import sqlite3
+import base64
+import gzip
+import io
+import shutil
+import signal
+import socket
+import subprocess
+import tempfile
+import threading
+import urllib.request
+import multiprocessing
+import multiprocessing.util
+from multiprocessing.managers import BaseManager
+from collections import OrderedDict
+from urllib.parse import urlsplit, urlunsplit
+from logging.handlers import QueueHandler, QueueListener
+from contextlib import asynccontextmanager
+from playwright.async_api import async_playwright, expect, BrowserContext, Page, Error as PlaywrightError
 import pathlib
 import json
+import httpx
 from dotenv import load_dotenv
 
+try:
+    from PIL import Image
+except ImportError:  # 未安装 Pillow 时跳过截图压缩
+    Image = None
+
 load_dotenv()
 
-mcp = FastMCP("browser use")
+# 服务级后台任务: 名称 -> asyncio.Task
+_background_tasks: Dict[str, asyncio.Task] = {}
+
+def start_background_tasks() -> None:
+    """
+    在当前事件循环中启动后台任务 (核对未完成的生成任务、生成结果预取器)。
+
+    任务句柄保存在模块级, 已经在运行或已经正常结束的任务不会重复启动,
+    被取消或异常退出的任务会重新启动。
+    """
+    loop = asyncio.get_running_loop()
+    for name, factory in (("reconcile_jobs", reconcile_jobs), ("prefetcher", run_prefetcher)):
+        task = _background_tasks.get(name)
+        if task is not None and task.get_loop() is loop and not (
+            task.done() and (task.cancelled() or task.exception() is not None)
+        ):
+            continue
+        _background_tasks[name] = loop.create_task(factory(), name=name)
+
+@asynccontextmanager
+async def server_lifespan(server: FastMCP):
+    """
+    服务启动时在后台核对上一次运行中未完成的生成任务, 并启动生成结果预取器。
+
+    部分 FastMCP 版本会为每个会话进入一次 lifespan, 因此退出时不取消后台任务,
+    否则第一个客户端断开就会永久停止它们; 任务随事件循环结束而结束。
+    """
+    start_background_tasks()
+    yield
+
+mcp = FastMCP("browser use", lifespan=server_lifespan)
+
+# trace 环形缓冲区配置: 失败时保留 trace, 成功时按采样率保留, 并限制文件数量和总大小
+TRACE_DIR = os.getenv("TRACE_DIR", "/root/traces/mcp-browser-use")
+TRACE_ON_ERROR = os.getenv("TRACE_ON_ERROR", "true").lower() in ("1", "true", "yes")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+TRACE_MAX_FILES = int(os.getenv("TRACE_MAX_FILES", "20"))
+TRACE_MAX_BYTES = int(os.getenv("TRACE_MAX_MB", "500")) * 1024 * 1024
+
+# 执行模式配置: 默认使用 VNC 上的有头浏览器; auto 模式优先使用无头 Chrome, 被拦截需要人工时回退到有头浏览器
+BROWSER_MODE = os.getenv("BROWSER_MODE", "headed")
+HEADLESS_CHANNEL = os.getenv("HEADLESS_CHANNEL", "chrome")
+HEADLESS_VIEWPORT = {"width": 1920, "height": 1080}
+# 页面跳转到这些地址时说明需要人工登录或验证
+HUMAN_REQUIRED_URL_PATTERN = re.compile(r"login|signin|sign-in|captcha|verify", re.IGNORECASE)
+# 页面中出现这些元素时视为被人机验证拦截
+HUMAN_REQUIRED_SELECTOR = os.getenv(
+    "HUMAN_REQUIRED_SELECTOR",
+    'iframe[src*="captcha"], [id*="captcha" i], [class*="captcha" i]',
+)
+
+# 幂等下载工具的结果缓存配置: 条目在 TTL 内有效, 超过容量时按 LRU 淘汰
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "3600"))
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "256"))
+
+# TikTok 批量下载配置: 同时打开的页面数和同时进行的文件下载数
+TIKTOK_PAGE_CONCURRENCY = int(os.getenv("TIKTOK_PAGE_CONCURRENCY", "4"))
+TIKTOK_DOWNLOAD_CONCURRENCY = int(os.getenv("TIKTOK_DOWNLOAD_CONCURRENCY", "8"))
+
+# 任务日志配置: 生成任务的里程碑写入 SQLite (WAL), 服务重启后据此核对而不是重新提交
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", "/root/data/jobs.sqlite3")
+# 在该时间窗口内, 参数相同且仍在执行或提交结果未确认 (started/submitted) 的任务不会被再次提交,
+# 用于服务重启或调用方重试时避免重复付费生成
+JOB_DEDUP_SECONDS = float(os.getenv("JOB_DEDUP_SECONDS", "3600"))
+# 开启后, 窗口内已经确认进入站点队列或已下载 (queued/downloaded) 的相同任务也直接返回
+JOB_DEDUP_COMPLETED = os.getenv("JOB_DEDUP_COMPLETED", "false").lower() in ("1", "true", "yes")
+
+# 浏览器地址与浏览器池配置: 多进程模式下, 由独立的管理进程集中调度有头浏览器和一组无头 Chrome
+CDP_URL = os.getenv("CDP_URL", "http://localhost:9222")
+HEADLESS_CHROME_PATH = os.getenv("HEADLESS_CHROME_PATH")
+HEADLESS_POOL_SIZE = int(os.getenv("HEADLESS_POOL_SIZE", "4"))
+HEADLESS_POOL_BASE_PORT = int(os.getenv("HEADLESS_POOL_BASE_PORT", "9300"))
+# 浏览器池 IPC 的认证密钥, 由 serve_workers 在 fork 之前随机生成
+BROWSER_POOL_AUTHKEY: Optional[bytes] = None
+BROWSER_LEASE_TIMEOUT = float(os.getenv("BROWSER_LEASE_TIMEOUT", "600"))
+BROWSER_LEASE_TTL = float(os.getenv("BROWSER_LEASE_TTL", "1800"))
+
+# Agent 截图压缩配置: 发送给 LLM 的截图裁剪到视口并缩放, 保存的历史记录使用 WebP/JPEG 并按感知哈希去重
+HISTORY_DIR = os.getenv("HISTORY_DIR", "/root/output/history")
+SCREENSHOT_MAX_WIDTH = int(os.getenv("SCREENSHOT_MAX_WIDTH", "1280"))
+SCREENSHOT_QUALITY = os.getenv("SCREENSHOT_QUALITY", "medium")
+SCREENSHOT_FORMAT = os.getenv("SCREENSHOT_FORMAT", "webp")
+SCREENSHOT_DEDUP_DISTANCE = int(os.getenv("SCREENSHOT_DEDUP_DISTANCE", "2"))
+# 质量档位: 保存到磁盘时的 WebP/JPEG 质量, 以及发送给 LLM 的 PNG 调色板颜色数 (None 表示不减色)
+SCREENSHOT_QUALITY_TIERS = {
+    "low": {"quality": 40, "colors": 64},
+    "medium": {"quality": 60, "colors": 256},
+    "high": {"quality": 80, "colors": None},
+}
+
+# 生成结果预取配置: 开启后在后台轮询已提交的生成任务, 完成后立即下载无水印版本
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "false").lower() in ("1", "true", "yes")
+PREFETCH_DOWNLOAD_PATH = os.getenv("PREFETCH_DOWNLOAD_PATH", "/root/file")
+PREFETCH_INTERVAL = float(os.getenv("PREFETCH_INTERVAL", "60"))
+PREFETCH_INITIAL_DELAY = float(os.getenv("PREFETCH_INITIAL_DELAY", "120"))
+PREFETCH_MAX_ATTEMPTS = int(os.getenv("PREFETCH_MAX_ATTEMPTS", "20"))
+
+# 日志配置: JSON lines 输出, 级别由环境变量控制, 单步调试事件按采样率记录
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_STEP_SAMPLE_RATE = float(os.getenv("LOG_STEP_SAMPLE_RATE", "0.1"))
+
+# 当前 MCP 调用的关联信息 (call_id, tool, task_id, session_id), 会附加到每一条日志上
+log_context: contextvars.ContextVar[Dict[str, Any]] = contextvars.ContextVar("log_context", default={})
+
+class JsonFormatter(logging.Formatter):
+    """将日志记录格式化为单行 JSON。"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "event": record.getMessage(),
+            **getattr(record, "context", {}),
+            **getattr(record, "fields", {}),
+        }
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+class LogContextFilter(logging.Filter):
+    """在调用方的协程中捕获关联信息, 供随后在调用方进行的 JSON 格式化使用。"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.context = log_context.get()
+        return True
+
+def setup_logging() -> logging.Logger:
+    """
+    创建非阻塞的结构化日志记录器。
+
+    日志在调用方格式化为 JSON 后放入队列, 由 QueueListener 的后台线程写到 stdout,
+    事件循环不会因为日志 I/O 被阻塞。
+
+    Returns:
+        logging.Logger: 配置好的日志记录器。
+    """
+    log_queue = queue.SimpleQueue()
+
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.setFormatter(JsonFormatter())
+    queue_handler.addFilter(LogContextFilter())
+
+    listener = QueueListener(log_queue, logging.StreamHandler(sys.stdout))
+    listener.start()
+    atexit.register(listener.stop)
+
+    mcp_logger = logging.getLogger("mcp_browser")
+    mcp_logger.handlers = [queue_handler]
+    mcp_logger.propagate = False
+    try:
+        mcp_logger.setLevel(LOG_LEVEL)
+    except ValueError:
+        # 无效的 LOG_LEVEL 不应导致服务无法启动
+        mcp_logger.setLevel(logging.INFO)
+        mcp_logger.warning("invalid_log_level", extra={"fields": {"log_level": LOG_LEVEL}})
+    return mcp_logger
+
+logger = setup_logging()
+
+def log_step(event: str, **fields: Any) -> None:
+    """按 LOG_STEP_SAMPLE_RATE 采样记录单步调试事件, 未开启 DEBUG 级别时几乎没有开销。"""
+    if logger.isEnabledFor(logging.DEBUG) and random.random() < LOG_STEP_SAMPLE_RATE:
+        logger.debug(event, extra={"fields": fields})
+
+class CallLoggingMiddleware(Middleware):
+    """为每一次 MCP 工具调用分配关联 ID, 并记录调用的耗时和结果。"""
+
+    async def on_call_tool(self, context: MiddlewareContext, call_next):
+        arguments = context.message.arguments or {}
+        call_context = {"call_id": uuid.uuid4().hex[:12], "tool": context.message.name}
+        for key in ("task_id", "session_id"):
+            if arguments.get(key):
+                call_context[key] = arguments[key]
+
+        token = log_context.set(call_context)
+        started = time.perf_counter()
+        logger.info("tool_call_start")
+        try:
+            result = await call_next(context)
+        except Exception:
+            logger.exception(
+                "tool_call_failed",
+                extra={"fields": {"duration_ms": round((time.perf_counter() - started) * 1000)}},
+            )
+            raise
+        else:
+            logger.info(
+                "tool_call_end",
+                extra={"fields": {"duration_ms": round((time.perf_counter() - started) * 1000)}},
+            )
+            return result
+        finally:
+            log_context.reset(token)
+
+mcp.add_middleware(CallLoggingMiddleware())
 
 class Result(BaseModel):
     """
@@ -35,6 +262,24 @@ class LLMProvider(str, Enum):
     GEMINI = "gemini"
     GROQ = "groq"
 
+class ExecutionMode(str, Enum):
+    """浏览器执行模式枚举。"""
+    AUTO = "auto"
+    HEADLESS = "headless"
+    HEADED = "headed"
+
+class JobStatus(str, Enum):
+    """任务日志中的里程碑状态枚举。"""
+    STARTED = "started"          # 流程已开始, 尚未提交到站点
+    SUBMITTED = "submitted"      # 已点击生成, 站点已接收任务
+    QUEUED = "queued"            # 已确认任务出现在站点的队列中
+    DOWNLOADED = "downloaded"    # 生成结果已下载到本地
+    FAILED = "failed"            # 提交前失败, 可以重新提交
+    INTERRUPTED = "interrupted"  # 服务重启时尚未提交, 可以重新提交
+
+class HumanRequiredError(RuntimeError):
+    """页面需要人工介入 (登录、短信验证码、人机验证等)。"""
+
 def create_llm_client(
     provider: LLMProvider, 
     model_name: str, 
@@ -102,16 +347,1436 @@ async def random_wait(min_seconds=1, max_seconds=2, verbose=True, wait_number=1)
     """
     if wait_number <= 0:
         if verbose:
-            print("🤖 等待次数为 0，跳过等待。")
+            log_step("random_wait_skipped")
         return
 
     for i in range(wait_number):
         delay = random.uniform(min_seconds, max_seconds)
         if verbose:
-            # 更新打印信息，显示当前等待的进度
-            print(f"🤖 第 {i + 1}/{wait_number} 次随机等待，时长 {delay:.2f} 秒，模拟人类操作...")
+            # 按采样率记录当前等待的进度
+            log_step("random_wait", attempt=i + 1, total=wait_number, delay=round(delay, 2))
         await asyncio.sleep(delay)
 
+def prune_traces(trace_dir: str = TRACE_DIR) -> None:
+    """
+    按修改时间淘汰最旧的 trace 文件, 使目录中的文件数量和总大小都保持在上限之内。
+
+    Args:
+        trace_dir (str): trace 文件所在目录。
+    """
+    # 多个工作进程共用同一个目录, 文件可能在列出之后被其他进程删除, 这类文件直接跳过
+    traces = []
+    for path in pathlib.Path(trace_dir).glob("*.zip"):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        traces.append((stat.st_mtime, stat.st_size, path))
+    traces.sort(key=lambda trace: trace[0])
+    total_bytes = sum(size for _, size, _ in traces)
+
+    while traces and (len(traces) > TRACE_MAX_FILES or total_bytes > TRACE_MAX_BYTES):
+        _, size, oldest = traces.pop(0)
+        total_bytes -= size
+        oldest.unlink(missing_ok=True)
+
+async def stop_trace(context: BrowserContext, tool_name: str, keep: bool) -> Optional[str]:
+    """
+    停止追踪。keep 为 True 时将 trace 写入环形缓冲目录, 否则直接丢弃。
+
+    Returns:
+        Optional[str]: 保存的 trace 文件路径, 未保存时为 None。
+    """
+    try:
+        if not keep:
+            await context.tracing.stop()
+            return None
+
+        try:
+            os.makedirs(TRACE_DIR, exist_ok=True)
+        except OSError as e:
+            # trace 目录不可写时丢弃本次 trace, 不能替换掉工具本身的异常
+            logger.warning("trace_dir_unavailable", extra={"fields": {"error": str(e)}})
+            await context.tracing.stop()
+            return None
+
+        trace_path = os.path.join(
+            TRACE_DIR,
+            f"{time.strftime('%Y%m%d-%H%M%S')}-{tool_name}-{uuid.uuid4().hex[:8]}.zip",
+        )
+        await context.tracing.stop(path=trace_path)
+        try:
+            prune_traces()
+        except OSError as e:
+            # 淘汰失败只影响目录大小, 不能替换掉工具本身的异常
+            logger.warning("trace_prune_failed", extra={"fields": {"error": str(e)}})
+        return trace_path
+    except PlaywrightError as e:
+        # 上下文已关闭或追踪未成功开启时, 不影响工具本身的结果
+        logger.warning("trace_stop_failed", extra={"fields": {"error": str(e)}})
+        return None
+
+@asynccontextmanager
+async def trace_capture(context: BrowserContext, tool_name: str):
+    """
+    按需捕获 Playwright trace。
+
+    TRACE_ON_ERROR 开启时每次调用都会开始追踪, 但只有在失败时才落盘;
+    成功的调用只有被 TRACE_SAMPLE_RATE 采样到时才会保留 trace。
+    """
+    sampled = random.random() < TRACE_SAMPLE_RATE
+    tracing = False
+
+    if sampled or TRACE_ON_ERROR:
+        try:
+            await context.tracing.start(name=tool_name, screenshots=True, snapshots=True)
+            tracing = True
+        except PlaywrightError as e:
+            # 同一个上下文上可能已有并发调用在追踪
+            logger.warning("trace_start_failed", extra={"fields": {"error": str(e)}})
+
+    try:
+        yield
+    except BaseException:
+        if tracing:
+            trace_path = await stop_trace(context, tool_name, keep=True)
+            if trace_path:
+                logger.info("trace_saved", extra={"fields": {"trace_path": trace_path}})
+        raise
+    else:
+        if tracing:
+            await stop_trace(context, tool_name, keep=sampled)
+
+class BrowserPool:
+    """
+    浏览器池, 运行在独立的管理进程中, 由所有 MCP 工作进程通过本地 IPC 共享。
+
+    有头浏览器 (VNC 上的 Chrome) 同一时间只租给一个流程; 无头浏览器是一组常驻的
+    headless Chrome 进程, 工作进程租到后通过 CDP 连接并创建独立的上下文。
+    租约记录持有者的进程 ID, 持有者进程退出 (例如工作进程崩溃) 后立即回收;
+    租约超过 BROWSER_LEASE_TTL 仍未归还时同样会被回收。
+    """
+
+    def __init__(self, headless_size: int, base_port: int):
+        self._condition = threading.Condition()
+        self._slots: Dict[str, List[Dict[str, Any]]] = {
+            "headed": [{"cdp_url": CDP_URL, "lease": None, "owner": None, "expires_at": 0.0}],
+            "headless": [
+                {
+                    "cdp_url": f"http://127.0.0.1:{base_port + i}",
+                    "port": base_port + i,
+                    "process": None,
+                    "lease": None,
+                    "owner": None,
+                    "expires_at": 0.0,
+                }
+                for i in range(headless_size)
+            ],
+        }
+
+    @staticmethod
+    def _owner_alive(pid: Optional[int]) -> bool:
+        """判断租约持有者进程是否仍在运行 (僵尸进程视为已退出)。"""
+        if pid is None:
+            return True
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+        except (OSError, IndexError):
+            return True
+
+    def _free_slot(self, kind: str) -> Optional[Dict[str, Any]]:
+        now = time.monotonic()
+        for slot in self._slots[kind]:
+            if slot["lease"] is None:
+                return slot
+            if slot["expires_at"] < now or not self._owner_alive(slot["owner"]):
+                logger.warning("browser_lease_reclaimed", extra={"fields": {"kind": kind, "owner": slot["owner"]}})
+                return slot
+        return None
+
+    def acquire(self, kind: str, timeout: float, owner: Optional[int] = None) -> Dict[str, str]:
+        """
+        租用一个浏览器, 没有空闲浏览器时最多等待 timeout 秒。
+
+        Args:
+            kind (str): 浏览器类型, headed 或 headless。
+            timeout (float): 最长等待时间 (秒)。
+            owner (Optional[int]): 租约持有者的进程 ID, 该进程退出后租约自动回收。
+
+        Returns:
+            Dict[str, str]: 包含租约 ID 和 CDP 地址。
+
+        Raises:
+            TimeoutError: 等待超时。
+        """
+        if not self._slots.get(kind):
+            raise ValueError(f"浏览器池中没有 {kind} 浏览器")
+
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while (slot := self._free_slot(kind)) is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"等待 {kind} 浏览器超时")
+                # 持有者进程退出时不会归还租约, 需要定期醒来检查
+                self._condition.wait(min(remaining, 1.0))
+
+            lease_id = uuid.uuid4().hex
+            slot["lease"] = lease_id
+            slot["owner"] = owner
+            slot["expires_at"] = time.monotonic() + BROWSER_LEASE_TTL
+
+        if kind == "headless":
+            try:
+                self._ensure_running(slot)
+            except Exception:
+                self.release(lease_id)
+                raise
+        return {"id": lease_id, "cdp_url": slot["cdp_url"]}
+
+    def release(self, lease_id: str) -> None:
+        """归还租约。"""
+        with self._condition:
+            for slots in self._slots.values():
+                for slot in slots:
+                    if slot["lease"] == lease_id:
+                        slot["lease"] = None
+                        slot["owner"] = None
+            self._condition.notify_all()
+
+    def _ensure_running(self, slot: Dict[str, Any]) -> None:
+        """无头 Chrome 进程未启动或已退出时 (重新) 启动, 并等待调试端口就绪。"""
+        process = slot["process"]
+        if process is not None and process.poll() is None:
+            return
+
+        chrome_path = HEADLESS_CHROME_PATH or next(
+            filter(None, map(shutil.which, ("google-chrome", "google-chrome-stable", "chromium", "chromium-browser"))),
+            None,
+        )
+        if chrome_path is None:
+            raise RuntimeError("未找到Chrome或Chromium浏览器")
+
+        slot["process"] = subprocess.Popen(
+            [
+                chrome_path,
+                "--headless=new",
+                f"--remote-debugging-port={slot['port']}",
+                f"--user-data-dir={tempfile.mkdtemp(prefix='headless-pool-')}",
+                "--no-first-run",
+                "--no-default-browser-check",
+                "--no-sandbox",
+                "--disable-dev-shm-usage",
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+        for _ in range(30):
+            try:
+                urllib.request.urlopen(f"{slot['cdp_url']}/json/version", timeout=1).close()
+                return
+            except OSError:
+                time.sleep(0.5)
+        raise RuntimeError(f"无头 Chrome 调试端口 {slot['port']} 未开放")
+
+    def shutdown(self) -> None:
+        """关闭所有无头 Chrome 进程。"""
+        for slot in self._slots["headless"]:
+            if slot["process"] is not None and slot["process"].poll() is None:
+                slot["process"].terminate()
+
+_browser_pool: Optional[BrowserPool] = None
+
+def get_browser_pool() -> BrowserPool:
+    """在管理进程中返回浏览器池单例。"""
+    global _browser_pool, logger
+    if _browser_pool is None:
+        # 管理进程由 fork 创建, 日志后台线程不会被继承, 需要重新创建
+        logger = setup_logging()
+        _browser_pool = BrowserPool(HEADLESS_POOL_SIZE, HEADLESS_POOL_BASE_PORT)
+        # 管理进程退出时不会执行 atexit, 需要通过 multiprocessing 的 finalizer 关闭无头 Chrome
+        multiprocessing.util.Finalize(_browser_pool, _browser_pool.shutdown, exitpriority=10)
+    return _browser_pool
+
+class BrowserPoolManager(BaseManager):
+    """通过本地 TCP 端口暴露浏览器池的管理器。"""
+
+BrowserPoolManager.register("pool", callable=get_browser_pool)
+
+class BrowserLeaseClient:
+    """
+    工作进程一侧的浏览器租约客户端。
+
+    配置了 BROWSER_POOL_ADDRESS 时向共享的浏览器池租用浏览器; 否则在进程内
+    串行化有头浏览器的使用, 无头流程自行启动浏览器。
+    """
+
+    def __init__(self, address: Optional[str]):
+        self.address = address
+        self._headed_lock = asyncio.Lock()
+        self._pool = None
+
+    def _remote_pool(self):
+        if self._pool is None:
+            host, port = self.address.rsplit(":", 1)
+            manager = BrowserPoolManager(address=(host, int(port)), authkey=BROWSER_POOL_AUTHKEY)
+            manager.connect()
+            self._pool = manager.pool()
+        return self._pool
+
+    @asynccontextmanager
+    async def lease(self, kind: str):
+        """
+        租用一个浏览器, 返回其 CDP 地址。未配置浏览器池且 kind 为 headless 时返回 None。
+        """
+        if not self.address:
+            if kind == "headed":
+                async with self._headed_lock:
+                    yield CDP_URL
+            else:
+                yield None
+            return
+
+        pool = self._remote_pool()
+        loop = asyncio.get_running_loop()
+        acquire = loop.run_in_executor(None, pool.acquire, kind, BROWSER_LEASE_TIMEOUT, os.getpid())
+        try:
+            lease = await asyncio.shield(acquire)
+        except asyncio.CancelledError:
+            # 线程中的 acquire 无法取消, 调用方取消后租到的浏览器需要立即归还
+            def release_abandoned(done: asyncio.Future) -> None:
+                if not done.cancelled() and done.exception() is None:
+                    loop.run_in_executor(None, pool.release, done.result()["id"])
+
+            acquire.add_done_callback(release_abandoned)
+            raise
+
+        try:
+            yield lease["cdp_url"]
+        finally:
+            # 归还放在 shield 中, 调用方被取消时也要完成归还
+            await asyncio.shield(loop.run_in_executor(None, pool.release, lease["id"]))
+
+browser_pool = BrowserLeaseClient(os.getenv("BROWSER_POOL_ADDRESS"))
+
+@asynccontextmanager
+async def cdp_page(tool_name: str, close_context: bool = False):
+    """
+    租用并连接到远程 Chrome 实例, 返回默认上下文中的第一个页面, 并在执行期间按需捕获 trace。
+
+    Args:
+        tool_name (str): 工具名称, 用于命名 trace 文件。
+        close_context (bool): 执行结束后是否关闭默认上下文。
+    """
+    async with browser_pool.lease("headed") as cdp_url, async_playwright() as p:
+        # Connect to the remote Chrome instance via its CDP endpoint
+        browser = await p.chromium.connect_over_cdp(cdp_url)
+
+        if not browser.contexts:
+            raise RuntimeError("No browser contexts found.")
+
+        # Access the default browser context
+        context = browser.contexts[0]
+
+        if not context.pages:
+            raise RuntimeError("No pages available in context.")
+
+        # Access the first page within the default context
+        page = context.pages[0]
+
+        async with trace_capture(context, tool_name):
+            yield page
+
+        if close_context:
+            await context.close()
+        # 关闭浏览器
+        await browser.close()
+
+@asynccontextmanager
+async def headless_page(tool_name: str):
+    """
+    获取无头 Chrome (浏览器池中的或本地启动的), 复制有头浏览器的登录状态、user agent 和语言,
+    在新的上下文中返回一个页面。
+
+    Args:
+        tool_name (str): 工具名称, 用于命名 trace 文件。
+    """
+    async with async_playwright() as p:
+        # 从有头浏览器中读取 cookies/localStorage 以及浏览器指纹, 保证两条路径的会话一致
+        headed_browser = await p.chromium.connect_over_cdp(CDP_URL)
+        if not headed_browser.contexts:
+            raise RuntimeError("No browser contexts found.")
+
+        headed_context = headed_browser.contexts[0]
+        storage_state = await headed_context.storage_state()
+        user_agent, locale = None, None
+        if headed_context.pages:
+            user_agent, locale = await headed_context.pages[0].evaluate(
+                "[navigator.userAgent, navigator.language]"
+            )
+        await headed_browser.close()
+
+        async with browser_pool.lease("headless") as pool_cdp_url:
+            if pool_cdp_url:
+                browser = await p.chromium.connect_over_cdp(pool_cdp_url)
+            else:
+                browser = await p.chromium.launch(
+                    channel=HEADLESS_CHANNEL,
+                    headless=True,
+                    args=["--no-sandbox", "--disable-dev-shm-usage"],
+                )
+            try:
+                context = await browser.new_context(
+                    storage_state=storage_state,
+                    user_agent=user_agent.replace("HeadlessChrome", "Chrome") if user_agent else None,
+                    locale=locale,
+                    viewport=HEADLESS_VIEWPORT,
+                    accept_downloads=True,
+                )
+                try:
+                    page = await context.new_page()
+
+                    async with trace_capture(context, tool_name):
+                        yield page
+                finally:
+                    # 共享的无头浏览器会继续运行, 需要显式关闭本次创建的上下文
+                    await context.close()
+            finally:
+                await browser.close()
+
+# 当前流程的执行状态, 用于判断失败时能否安全地回退到有头浏览器重试
+flow_attempt: contextvars.ContextVar[Dict[str, bool]] = contextvars.ContextVar("flow_attempt")
+# 当前流程对应的任务日志 ID
+current_job: contextvars.ContextVar[str] = contextvars.ContextVar("current_job")
+
+def mark_submitted() -> None:
+    """标记流程已经执行了不可重复的操作 (例如提交生成任务), 之后失败不再回退重试。"""
+    attempt = flow_attempt.get(None)
+    if attempt is not None:
+        attempt["submitted"] = True
+
+    job_id = current_job.get(None)
+    if job_id is not None:
+        job_journal.update(job_id, JobStatus.SUBMITTED)
+
+async def check_human_required(page: Page) -> None:
+    """
+    检查页面是否被重定向到登录或人机验证页面, 或者页面中出现了人机验证元素。
+
+    Raises:
+        HumanRequiredError: 页面需要人工介入时。
+    """
+    if HUMAN_REQUIRED_URL_PATTERN.search(page.url):
+        raise HumanRequiredError(f"页面需要人工介入: {page.url}")
+
+    try:
+        blocked = await page.locator(HUMAN_REQUIRED_SELECTOR).count() > 0
+    except PlaywrightError:
+        # 页面已关闭或正在跳转, 无法判断时按未拦截处理
+        return
+    if blocked:
+        raise HumanRequiredError(f"页面出现人机验证: {page.url}")
+
+async def run_flow(
+    tool_name: str,
+    flow: Callable[[Page], Awaitable[Dict[str, Any]]],
+    mode: Optional[ExecutionMode] = None,
+    close_context: bool = False,
+) -> Dict[str, Any]:
+    """
+    按执行模式运行浏览器流程。
+
+    auto 模式下先在无头 Chrome 中执行, 只有当无头路径被拦截 (跳转到登录页、出现人机验证) 需要人工介入,
+    并且流程还没有提交不可重复的操作时, 才回退到 VNC 上的有头浏览器重新执行。
+    普通的超时或元素缺失 (例如参数错误、站点改版) 直接抛出, 不会重复执行流程。
+
+    Args:
+        tool_name (str): 工具名称。
+        flow (Callable[[Page], Awaitable[Dict[str, Any]]]): 在页面上执行的流程。
+        mode (Optional[ExecutionMode]): 执行模式, 为空时使用 BROWSER_MODE。
+        close_context (bool): 有头模式下执行结束后是否关闭默认上下文。
+
+    Returns:
+        Dict[str, Any]: 流程的返回结果。
+    """
+    mode = ExecutionMode(mode or BROWSER_MODE)
+
+    if mode != ExecutionMode.HEADED:
+        attempt = {"submitted": False}
+        token = flow_attempt.set(attempt)
+        try:
+            async with headless_page(tool_name) as page:
+                try:
+                    return await flow(page)
+                except (PlaywrightError, AssertionError):
+                    # 超时或元素缺失时检查页面是否被拦截; 没有拦截迹象时是流程本身的错误, 不回退
+                    await check_human_required(page)
+                    raise
+        except HumanRequiredError as e:
+            if mode == ExecutionMode.HEADLESS or attempt["submitted"]:
+                raise
+            logger.warning("headless_fallback", extra={"fields": {"error": str(e)}})
+        finally:
+            flow_attempt.reset(token)
+
+    async with cdp_page(tool_name, close_context=close_context) as page:
+        return await flow(page)
+
+class ResultCache:
+    """
+    幂等工具的结果缓存。
+
+    并发的相同请求会合并为一次执行; 执行成功后结果按 TTL/LRU 缓存。缓存条目指向
+    download_path 中已下载的文件, 文件被删除或覆盖后条目自动失效。
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        # key -> (过期时间, 结果, 文件路径, 文件修改时间)
+        self._entries: "OrderedDict[str, Tuple[float, Dict[str, Any], str, float]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Task] = {}
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """返回仍然有效的缓存结果, 过期或文件已变化时返回 None。"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires_at, result, file_path, mtime = entry
+        if (
+            expires_at < time.monotonic()
+            or not os.path.isfile(file_path)
+            or os.path.getmtime(file_path) != mtime
+        ):
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return dict(result)
+
+    def put(self, key: str, result: Dict[str, Any], file_path: str) -> None:
+        """缓存结果, 文件不存在时不缓存。"""
+        if self.max_size <= 0 or not os.path.isfile(file_path):
+            return
+
+        self._entries[key] = (time.monotonic() + self.ttl, result, file_path, os.path.getmtime(file_path))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def run(
+        self,
+        key: str,
+        factory: Callable[[], Awaitable[Dict[str, Any]]],
+        file_of: Callable[[Dict[str, Any]], str],
+    ) -> Dict[str, Any]:
+        """
+        优先返回缓存结果; 相同 key 的请求正在执行时等待它的结果; 否则执行 factory。
+
+        Args:
+            key (str): 由规范化参数生成的缓存键。
+            factory (Callable[[], Awaitable[Dict[str, Any]]]): 实际执行工具的协程工厂。
+            file_of (Callable[[Dict[str, Any]], str]): 从结果中取出下载文件路径。
+
+        Returns:
+            Dict[str, Any]: 工具的执行结果。
+        """
+        result = self.get(key)
+        if result is not None:
+            logger.info("result_cache_hit")
+            return result
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._on_done(key, done, file_of))
+        else:
+            logger.info("request_coalesced")
+
+        # shield: 某个调用方被取消时, 不影响其它等待同一结果的调用方
+        return dict(await asyncio.shield(task))
+
+    def _on_done(self, key: str, task: asyncio.Task, file_of: Callable[[Dict[str, Any]], str]) -> None:
+        self._inflight.pop(key, None)
+        if task.cancelled() or task.exception() is not None:
+            return
+        self.put(key, task.result(), file_of(task.result()))
+
+result_cache = ResultCache(max_size=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL)
+
+def normalize_url(url: str, drop_query: bool = False) -> str:
+    """
+    规范化 URL, 用于生成缓存键: 去掉首尾空白和 fragment, 协议和域名转为小写,
+    去掉末尾的斜杠, drop_query 为 True 时同时去掉查询参数 (例如分享来源参数)。
+    """
+    parts = urlsplit(url.strip())
+    return urlunsplit((
+        parts.scheme.lower(),
+        parts.netloc.lower(),
+        parts.path.rstrip("/"),
+        "" if drop_query else parts.query,
+        "",
+    ))
+
+def cache_key(tool_name: str, *args: Any) -> str:
+    """由工具名称和规范化后的参数生成缓存键。"""
+    return json.dumps([tool_name, *args], ensure_ascii=False)
+
+class JobJournal:
+    """
+    基于 SQLite (WAL) 的持久化任务日志。
+
+    每个生成任务在提交前写入一条 started 记录, 之后依次更新为 submitted、queued、downloaded。
+    服务被 supervisord 重启后, 可以据此判断任务是否已经提交, 避免重复付费生成。
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        # 每个进程使用自己的连接, 多进程之间由 WAL 保证并发读写
+        if self._conn is None or self._pid != os.getpid():
+            db_directory = os.path.dirname(self.db_path)
+            if db_directory:
+                os.makedirs(db_directory, exist_ok=True)
+
+            conn = sqlite3.connect(self.db_path, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    tool TEXT NOT NULL,
+                    job_key TEXT NOT NULL,
+                    prompt TEXT,
+                    work_type TEXT,
+                    status TEXT NOT NULL,
+                    result TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_job_key ON jobs (job_key, created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS prefetch_jobs (
+                    job_id TEXT PRIMARY KEY REFERENCES jobs (id),
+                    download_path TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL
+                )
+                """
+            )
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    @staticmethod
+    def _to_dict(row: Optional[sqlite3.Row]) -> Optional[Dict[str, Any]]:
+        if row is None:
+            return None
+        job = dict(row)
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def start(
+        self,
+        tool: str,
+        job_key: str,
+        prompt: Optional[str],
+        work_type: Optional[str],
+        dedup_since: Optional[float] = None,
+        dedup_statuses: Tuple[JobStatus, ...] = (JobStatus.STARTED, JobStatus.SUBMITTED),
+    ) -> Tuple[str, Optional[Dict[str, Any]]]:
+        """
+        写入一条 started 记录。
+
+        dedup_since 不为空时, 在同一个写事务中先查找 dedup_since 之后参数相同、状态属于 dedup_statuses 的任务,
+        找到则不写入新记录。多个进程同时提交相同的任务时只有一个会写入成功。
+
+        Returns:
+            Tuple[str, Optional[Dict[str, Any]]]: 任务 ID 和已存在的任务 (新写入时为 None)。
+        """
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if dedup_since is not None:
+                existing = self._to_dict(conn.execute(
+                    "SELECT * FROM jobs WHERE job_key = ? AND created_at >= ? "
+                    f"AND status IN ({', '.join('?' * len(dedup_statuses))}) "
+                    "ORDER BY created_at DESC LIMIT 1",
+                    (job_key, dedup_since, *(status.value for status in dedup_statuses)),
+                ).fetchone())
+                if existing is not None:
+                    conn.execute("COMMIT")
+                    return existing["id"], existing
+
+            job_id = uuid.uuid4().hex
+            now = time.time()
+            conn.execute(
+                "INSERT INTO jobs (id, tool, job_key, prompt, work_type, status, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, tool, job_key, prompt, work_type, JobStatus.STARTED.value, now, now),
+            )
+            conn.execute("COMMIT")
+            return job_id, None
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def update(
+        self,
+        job_id: str,
+        status: JobStatus,
+        result: Optional[Dict[str, Any]] = None,
+        error: Optional[str] = None,
+    ) -> None:
+        """更新任务状态, result/error 为空时保留原值。"""
+        self.conn.execute(
+            "UPDATE jobs SET status = ?, result = COALESCE(?, result), error = COALESCE(?, error), updated_at = ? "
+            "WHERE id = ?",
+            (
+                status.value,
+                json.dumps(result, ensure_ascii=False) if result is not None else None,
+                error,
+                time.time(),
+                job_id,
+            ),
+        )
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return self._to_dict(self.conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def find_by_prompt(
+        self,
+        text: str,
+        work_type: Optional[str] = None,
+        exact: bool = False,
+    ) -> Optional[Dict[str, Any]]:
+        """
+        按提示词查找最新的已提交任务。默认按片段匹配; exact 为 True 时要求提示词完全相同,
+        把下载结果关联到生成任务时使用, 避免关联到包含该片段的其他任务。
+        """
+        query = "SELECT * FROM jobs WHERE {} AND status IN (?, ?, ?)".format(
+            "prompt = ?" if exact else "instr(prompt, ?) > 0"
+        )
+        params: List[Any] = [text, JobStatus.SUBMITTED.value, JobStatus.QUEUED.value, JobStatus.DOWNLOADED.value]
+        if work_type:
+            query += " AND work_type = ?"
+            params.append(work_type)
+        query += " ORDER BY created_at DESC LIMIT 1"
+        return self._to_dict(self.conn.execute(query, params).fetchone())
+
+    def unfinished(self) -> List[Dict[str, Any]]:
+        """返回尚未确认进入站点队列的任务。"""
+        rows = self.conn.execute(
+            "SELECT * FROM jobs WHERE status IN (?, ?) ORDER BY created_at",
+            (JobStatus.STARTED.value, JobStatus.SUBMITTED.value),
+        ).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def enqueue_prefetch(self, job_id: str, download_path: str, delay: float) -> None:
+        """把任务加入预取队列, delay 秒后开始尝试下载。"""
+        self.conn.execute(
+            "INSERT OR IGNORE INTO prefetch_jobs (job_id, download_path, next_attempt_at) VALUES (?, ?, ?)",
+            (job_id, download_path, time.time() + delay),
+        )
+
+    def claim_prefetch(self, lease_seconds: float) -> List[Dict[str, Any]]:
+        """
+        领取到期的预取任务。领取时把下一次尝试时间推迟 lease_seconds,
+        多个工作进程同时轮询时每个任务只会被一个进程领取。
+        """
+        now = time.time()
+        rows = self.conn.execute(
+            "SELECT prefetch_jobs.*, jobs.prompt, jobs.work_type, jobs.status FROM prefetch_jobs "
+            "JOIN jobs ON jobs.id = prefetch_jobs.job_id WHERE next_attempt_at <= ? ORDER BY next_attempt_at",
+            (now,),
+        ).fetchall()
+
+        claimed = []
+        for row in rows:
+            cursor = self.conn.execute(
+                "UPDATE prefetch_jobs SET next_attempt_at = ? WHERE job_id = ? AND next_attempt_at <= ?",
+                (now + lease_seconds, row["job_id"], now),
+            )
+            if cursor.rowcount == 1:
+                claimed.append(dict(row))
+        return claimed
+
+    def retry_prefetch(self, job_id: str, delay: float) -> int:
+        """记录一次失败的预取尝试, delay 秒后重试, 返回已尝试的次数。"""
+        self.conn.execute(
+            "UPDATE prefetch_jobs SET attempts = attempts + 1, next_attempt_at = ? WHERE job_id = ?",
+            (time.time() + delay, job_id),
+        )
+        row = self.conn.execute("SELECT attempts FROM prefetch_jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return row["attempts"] if row else 0
+
+    def finish_prefetch(self, job_id: str) -> None:
+        """把任务移出预取队列。"""
+        self.conn.execute("DELETE FROM prefetch_jobs WHERE job_id = ?", (job_id,))
+
+job_journal = JobJournal(JOB_DB_PATH)
+
+# 当前进程中正在执行的生成任务: job_key -> asyncio.Task
+_inflight_jobs: Dict[str, asyncio.Task] = {}
+
+async def run_job(
+    tool_name: str,
+    arguments: Dict[str, Any],
+    flow: Callable[[Page], Awaitable[Dict[str, Any]]],
+    mode: Optional[ExecutionMode] = None,
+    prompt: Optional[str] = None,
+    work_type: Optional[str] = None,
+    prefetch: Optional[bool] = None,
+    force: bool = False,
+) -> Dict[str, Any]:
+    """
+    在任务日志中记录并执行一个生成流程。
+
+    参数相同的任务在 JOB_DEDUP_SECONDS 内仍在执行或提交结果未确认时, 直接返回已有任务而不是再次提交;
+    已经确认进入站点队列的任务默认不去重 (JOB_DEDUP_COMPLETED 开启时同样直接返回);
+    同一进程中并发的相同调用合并为一次执行, 其他进程中正在执行的相同任务以 started 状态返回。
+    流程在提交之后失败时任务保持 submitted 状态, 调用方重试也不会重复提交。
+
+    Args:
+        tool_name (str): 工具名称。
+        arguments (Dict[str, Any]): 用于识别重复任务的工具参数。
+        flow (Callable[[Page], Awaitable[Dict[str, Any]]]): 生成流程, 提交后需调用 mark_submitted()。
+        mode (Optional[ExecutionMode]): 执行模式。
+        prompt (Optional[str]): 任务的提示词, 用于在站点上核对和下载结果。
+        work_type (Optional[str]): 站点上的作品类型 (视频/图片)。
+        prefetch (Optional[bool]): 是否在生成完成后自动下载结果, 为空时使用 PREFETCH_ENABLED。
+        force (bool): 为 True 时跳过去重, 总是提交新任务。
+
+    Returns:
+        Dict[str, Any]: 流程结果, 附带 job_id 和 job_status。
+    """
+    job_key = cache_key(tool_name, arguments)
+    if not force and job_key in _inflight_jobs:
+        logger.info("job_coalesced")
+        return dict(await asyncio.shield(_inflight_jobs[job_key]))
+
+    job_id, existing = job_journal.start(
+        tool_name,
+        job_key,
+        prompt,
+        work_type,
+        dedup_since=None if force else time.time() - JOB_DEDUP_SECONDS,
+        dedup_statuses=(
+            (JobStatus.STARTED, JobStatus.SUBMITTED, JobStatus.QUEUED, JobStatus.DOWNLOADED)
+            if JOB_DEDUP_COMPLETED
+            else (JobStatus.STARTED, JobStatus.SUBMITTED)
+        ),
+    )
+    if existing is not None:
+        logger.info("job_already_submitted", extra={"fields": {"job_id": existing["id"], "status": existing["status"]}})
+        return {**(existing["result"] or {}), "job_id": existing["id"], "job_status": existing["status"]}
+
+    async def execute() -> Dict[str, Any]:
+        token = current_job.set(job_id)
+        try:
+            result = await run_flow(tool_name, flow, mode)
+        except BaseException as e:
+            job = job_journal.get(job_id)
+            status = JobStatus.FAILED if job["status"] == JobStatus.STARTED.value else JobStatus(job["status"])
+            job_journal.update(job_id, status, error=str(e) or type(e).__name__)
+            raise
+        finally:
+            current_job.reset(token)
+
+        status = JobStatus.QUEUED if result.get("is_visible", True) else JobStatus.SUBMITTED
+        job_journal.update(job_id, status, result=result)
+
+        if (PREFETCH_ENABLED if prefetch is None else prefetch) and work_type and prompt:
+            job_journal.enqueue_prefetch(job_id, PREFETCH_DOWNLOAD_PATH, PREFETCH_INITIAL_DELAY)
+        return {**result, "job_id": job_id, "job_status": status.value}
+
+    task = asyncio.ensure_future(execute())
+    if not force:
+        _inflight_jobs[job_key] = task
+        task.add_done_callback(lambda done: _inflight_jobs.pop(job_key, None) if _inflight_jobs.get(job_key) is done else None)
+    # shield: 调用方断开时已经开始的生成任务继续执行, 结果仍会记录到任务日志
+    return dict(await asyncio.shield(task))
+
+_jobs_reconciled = False
+
+async def reconcile_jobs(retry_interval: float = 10, max_attempts: int = 30) -> None:
+    """
+    核对上一次运行中未完成的任务。
+
+    对于海螺任务, 在站点的作品列表中查找提示词: 找到则标记为 queued, 否则 started 的任务
+    标记为 interrupted (可以重新提交)。无法核对的 started 任务同样标记为 interrupted,
+    submitted 的任务保持不变, 绝不会被自动重新提交。
+    """
+    global _jobs_reconciled
+    if _jobs_reconciled:
+        return
+
+    await _reconcile_unfinished_jobs(retry_interval, max_attempts)
+    # 完成后才设置标记, 核对被取消时下次启动后台任务会重新执行
+    _jobs_reconciled = True
+
+async def _reconcile_unfinished_jobs(retry_interval: float, max_attempts: int) -> None:
+    jobs = job_journal.unfinished()
+    if not jobs:
+        return
+
+    hailuo_jobs = [job for job in jobs if job["work_type"] and job["prompt"]]
+    for job in jobs:
+        if job not in hailuo_jobs and job["status"] == JobStatus.STARTED.value:
+            job_journal.update(job["id"], JobStatus.INTERRUPTED, error="服务重启时任务尚未提交")
+    if not hailuo_jobs:
+        return
+
+    async def flow(page: Page) -> Dict[str, Any]:
+        await page.goto("https://hailuoai.com/create?type=video")
+        await check_human_required(page)
+        await expect(page.get_by_text('文生视频')).to_be_visible(timeout=5000)
+
+        reconciled = {}
+        for work_type in sorted({job["work_type"] for job in hailuo_jobs}):
+            await page.get_by_text('类型:').click()
+            await page.get_by_role("option", name=work_type).click()
+            await random_wait()
+
+            for job in hailuo_jobs:
+                if job["work_type"] == work_type:
+                    # 使用完整的提示词匹配, 避免把前缀相同的旧作品误认为本次提交的任务
+                    reconciled[job["id"]] = await page.get_by_text(job["prompt"]).first.is_visible()
+        return reconciled
+
+    # chrome-cdp 进程可能晚于本服务启动, 连接失败时稍后重试
+    for attempt in range(max_attempts):
+        try:
+            reconciled = await run_flow("reconcile_jobs", flow)
+            break
+        except Exception as e:
+            logger.warning("job_reconcile_retry", extra={"fields": {"attempt": attempt + 1, "error": str(e)}})
+            await asyncio.sleep(retry_interval)
+    else:
+        reconciled = {}
+
+    for job in hailuo_jobs:
+        if reconciled.get(job["id"]):
+            job_journal.update(job["id"], JobStatus.QUEUED, result={**(job["result"] or {}), "is_visible": True})
+        elif job["status"] == JobStatus.STARTED.value:
+            job_journal.update(job["id"], JobStatus.INTERRUPTED, error="服务重启时任务尚未提交")
+        logger.info("job_reconciled", extra={"fields": {"job_id": job["id"], "queued": bool(reconciled.get(job["id"]))}})
+
+async def hailuo_download_flow(
+    page: Page,
+    text: str,
+    type_of_work: str,
+    download_path: str,
+    wait_number: int = 1,
+    job_id: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    在海螺的作品列表中找到指定作品, 下载无水印版本, 并把下载结果记录到对应的生成任务上。
+
+    Args:
+        page (Page): 浏览器页面。
+        text (str): 作品的唯一定位描述。
+        type_of_work (str): 作品类型, 视频或图片。
+        download_path (str): 下载文件保存目录。
+        wait_number (int): 单步动作等待的次数。
+        job_id (Optional[str]): 对应的生成任务; 为空时只关联提示词与 text 完全相同的任务。
+
+    Returns:
+        Dict[str, Any]: 包含下载文件名的结果。
+    """
+    # 进入页面
+    await page.goto("https://hailuoai.com/create?type=video")
+    await check_human_required(page)
+    await expect(page.get_by_text('文生视频')).to_be_visible(timeout=5000)
+    await random_wait(wait_number=wait_number)
+
+    # 点击右边的类型
+    await page.get_by_text('类型:').click();
+    await random_wait(wait_number=wait_number)
+    
+    # 选择显示类型
+    await page.get_by_role("option", name=type_of_work).click()
+    await random_wait(wait_number=wait_number)
+
+    # 定位到指定视频的弹出层
+    await page.locator("#preview-video-scroll-container div").filter(has_text=text).nth(2).click()
+    await random_wait(wait_number=wait_number)
+
+    # 将鼠标移动到指定位置, 并单击
+    if type_of_work == "图片":
+        await page.get_by_role("main").filter(has_text=f"创意描述复制{text}").get_by_role("button").nth(1).click()
+    elif type_of_work == "视频":
+        await page.locator(".mt-auto > .pointer-events-auto > button").first.click()
+    await random_wait(wait_number=wait_number)
+
+    # 验证无水印按钮是否存在
+    element_to_check = page.get_by_role("menuitem", name="无水印").locator("div")
+    await expect(element_to_check).to_be_visible()
+    await random_wait(wait_number=wait_number)
+
+    # 下载视频
+    async with page.expect_download() as download_info:
+        await element_to_check.click()
+    download = await download_info.value
+    
+    # 将下载文件保存到指定路径
+    suggested_filename = download.suggested_filename
+    save_file_path = os.path.join(download_path, suggested_filename)
+    await download.save_as(save_file_path)
+    await random_wait(wait_number=wait_number)
+
+    # 将下载结果记录到对应的生成任务上
+    record_download(text, type_of_work, save_file_path, job_id)
+
+    return {
+        "filePath": download.suggested_filename
+    }
+
+def record_download(text: str, type_of_work: str, file_path: str, job_id: Optional[str] = None) -> Optional[str]:
+    """
+    把下载的文件记录到对应的生成任务上。
+
+    Args:
+        text (str): 下载时使用的作品描述。
+        type_of_work (str): 作品类型, 视频或图片。
+        file_path (str): 下载文件的保存路径。
+        job_id (Optional[str]): 对应的生成任务; 为空时只关联提示词与 text 完全相同的任务。
+
+    Returns:
+        Optional[str]: 被更新的任务 ID, 没有对应任务时返回 None。
+    """
+    if job_id is not None:
+        job = job_journal.get(job_id)
+    else:
+        job = job_journal.find_by_prompt(text, type_of_work if type_of_work in ("视频", "图片") else None, exact=True)
+    if job is None:
+        return None
+
+    job_journal.update(job["id"], JobStatus.DOWNLOADED, result={**(job["result"] or {}), "filePath": file_path})
+    return job["id"]
+
+def link_or_copy(src: str, dst: str) -> None:
+    """在同一文件系统上创建硬链接, 跨文件系统或不支持硬链接时复制文件。"""
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    try:
+        if os.path.exists(dst):
+            os.unlink(dst)
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+async def find_downloaded_result(text: str, type_of_work: str, download_path: str) -> Optional[Dict[str, Any]]:
+    """
+    查找已经下载到本地的生成结果 (由预取器或之前的下载保存), 必要时链接或复制到 download_path。
+    只使用提示词与 text 完全相同的任务的结果。
+
+    Returns:
+        Optional[Dict[str, Any]]: 与 download_video 相同格式的结果, 没有可用文件时返回 None。
+    """
+    job = job_journal.find_by_prompt(text, type_of_work if type_of_work in ("视频", "图片") else None, exact=True)
+    if job is None or job["status"] != JobStatus.DOWNLOADED.value:
+        return None
+
+    file_path = (job["result"] or {}).get("filePath")
+    if not file_path or not os.path.isfile(file_path):
+        return None
+
+    target_path = os.path.join(download_path, os.path.basename(file_path))
+    if os.path.abspath(target_path) != os.path.abspath(file_path):
+        await asyncio.to_thread(link_or_copy, file_path, target_path)
+
+    logger.info("prefetch_hit", extra={"fields": {"job_id": job["id"], "file_path": target_path}})
+    return {
+        "filePath": os.path.basename(file_path)
+    }
+
+async def run_prefetcher() -> None:
+    """
+    生成结果预取器: 定期领取到期的预取任务, 在海螺的作品列表中下载无水印版本。
+
+    预取只在无头浏览器中执行, 不会回退到有头浏览器, 后台轮询不会占用用户调用需要的 VNC 浏览器。
+    作品尚未生成完成时 (找不到作品或无水印菜单) 按指数退避稍后重试,
+    超过 PREFETCH_MAX_ATTEMPTS 次后放弃, 调用方仍可以通过 download_video 手动下载。
+    由 start_background_tasks 保证每个进程只运行一个预取器。
+    """
+    while True:
+        await asyncio.sleep(PREFETCH_INTERVAL)
+        try:
+            jobs = job_journal.claim_prefetch(lease_seconds=PREFETCH_INTERVAL * 10)
+        except sqlite3.Error as e:
+            logger.warning("prefetch_claim_failed", extra={"fields": {"error": str(e)}})
+            continue
+
+        for job in jobs:
+            token = log_context.set({"job_id": job["job_id"], "tool": "prefetch"})
+            try:
+                if job["status"] == JobStatus.DOWNLOADED.value:
+                    job_journal.finish_prefetch(job["job_id"])
+                    continue
+
+                await run_flow(
+                    "prefetch",
+                    lambda page: hailuo_download_flow(
+                        page, job["prompt"], job["work_type"], job["download_path"], job_id=job["job_id"]
+                    ),
+                    ExecutionMode.HEADLESS,
+                )
+                job_journal.finish_prefetch(job["job_id"])
+                logger.info("prefetch_downloaded")
+            except Exception as e:
+                attempts = job_journal.retry_prefetch(
+                    job["job_id"],
+                    delay=min(PREFETCH_INTERVAL * 2 ** job["attempts"], 900),
+                )
+                if attempts >= PREFETCH_MAX_ATTEMPTS:
+                    job_journal.finish_prefetch(job["job_id"])
+                    logger.warning("prefetch_gave_up", extra={"fields": {"attempts": attempts, "error": str(e)}})
+                else:
+                    logger.info("prefetch_not_ready", extra={"fields": {"attempts": attempts, "error": str(e)}})
+            finally:
+                log_context.reset(token)
+
+class ScreenshotPipeline:
+    """
+    Agent 截图压缩流水线: 裁剪到视口区域、按质量档位减色或重新编码,
+    保存历史记录时用感知哈希 (dHash) 识别重复帧。
+
+    发送给 LLM 的截图总是当前帧: 9x8 的感知哈希看不出输入的文字、勾选框等细小变化,
+    只有与上一帧字节完全相同时才复用上一帧的压缩结果。
+
+    发送给 LLM 的截图尺寸由 browser_use 的 llm_screenshot_size 决定 (见 llm_size),
+    browser_use 据此把 LLM 给出的坐标换算回视口坐标; 流水线只缩放到这个尺寸,
+    不自行决定大小。browser_use 以 image/png 的类型把截图发送给 LLM, 因此这里仍编码为 PNG,
+    通过调色板减色来压缩; 保存到磁盘的帧缩放到 max_width 并使用 WebP/JPEG。
+    """
+
+    def __init__(
+        self,
+        max_width: int = SCREENSHOT_MAX_WIDTH,
+        quality: str = SCREENSHOT_QUALITY,
+        image_format: str = SCREENSHOT_FORMAT,
+        dedup_distance: int = SCREENSHOT_DEDUP_DISTANCE,
+    ):
+        self.max_width = max_width
+        self.tier = SCREENSHOT_QUALITY_TIERS.get(quality, SCREENSHOT_QUALITY_TIERS["medium"])
+        self.image_format = "jpeg" if image_format.lower() in ("jpg", "jpeg") else "webp"
+        self.dedup_distance = dedup_distance
+        self._last_input: Optional[Tuple[str, Optional[Tuple[int, int]]]] = None
+        self._last_output: Optional[str] = None
+
+    @staticmethod
+    def perceptual_hash(image: "Image.Image") -> int:
+        """计算 64 位 dHash: 缩小为 9x8 的灰度图, 比较相邻像素的明暗。"""
+        pixels = image.convert("L").resize((9, 8), Image.BILINEAR).tobytes()
+        frame_hash = 0
+        for row in range(8):
+            for col in range(8):
+                frame_hash = (frame_hash << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+        return frame_hash
+
+    def is_duplicate(self, hash_a: Optional[int], hash_b: Optional[int]) -> bool:
+        return hash_a is not None and hash_b is not None and bin(hash_a ^ hash_b).count("1") <= self.dedup_distance
+
+    def prepare(
+        self,
+        screenshot: str,
+        viewport: Optional[Tuple[int, int]] = None,
+    ) -> Tuple["Image.Image", int]:
+        """
+        解码 base64 截图并裁剪到视口区域。
+
+        Args:
+            screenshot (str): base64 编码的截图。
+            viewport (Optional[Tuple[int, int]]): 视口的宽和高, 截图比视口更长时只保留首屏。
+
+        Returns:
+            Tuple[Image.Image, int]: 裁剪后的图片和它的感知哈希。
+        """
+        image = Image.open(io.BytesIO(base64.b64decode(screenshot)))
+        image.load()
+
+        if viewport and viewport[0] and viewport[1]:
+            viewport_height = round(image.width * viewport[1] / viewport[0])
+            if image.height > viewport_height:
+                image = image.crop((0, 0, image.width, viewport_height))
+        return image, self.perceptual_hash(image)
+
+    def llm_size(self, viewport: Tuple[int, int]) -> Tuple[int, int]:
+        """按视口比例计算发送给 LLM 的截图尺寸, 宽度不超过 max_width。"""
+        width = min(viewport[0], self.max_width)
+        return width, round(viewport[1] * width / viewport[0])
+
+    def compress_for_llm(
+        self,
+        screenshot: str,
+        viewport: Optional[Tuple[int, int]] = None,
+        size: Optional[Tuple[int, int]] = None,
+    ) -> str:
+        """
+        压缩发送给 LLM 的截图; 与上一帧完全相同时直接复用上一帧的压缩结果。
+
+        Args:
+            screenshot (str): base64 编码的截图。
+            viewport (Optional[Tuple[int, int]]): 视口的宽和高, 用于裁剪。
+            size (Optional[Tuple[int, int]]): browser_use 的 llm_screenshot_size。
+                缩放必须在减色之前完成, 否则 browser_use 会以最近邻插值缩放调色板图片。
+
+        Returns:
+            str: base64 编码的 PNG 截图。
+        """
+        if (screenshot, size) == self._last_input:
+            return self._last_output
+
+        image, _ = self.prepare(screenshot, viewport)
+        image = image.convert("RGB")
+        if size and image.size != tuple(size):
+            image = image.resize(tuple(size), Image.LANCZOS)
+        if self.tier["colors"]:
+            image = image.quantize(colors=self.tier["colors"])
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG", optimize=True)
+
+        self._last_input = (screenshot, size)
+        self._last_output = base64.b64encode(buffer.getvalue()).decode()
+        return self._last_output
+
+    def encode_frame(self, image: "Image.Image") -> bytes:
+        """按质量档位把帧编码为 WebP/JPEG。"""
+        buffer = io.BytesIO()
+        image.convert("RGB").save(buffer, format=self.image_format.upper(), quality=self.tier["quality"])
+        return buffer.getvalue()
+
+class CompressingBrowserSession(BrowserSession):
+    """
+    在浏览器状态交给 Agent 之前压缩其中截图的 BrowserSession。
+
+    没有通过 Agent(llm_screenshot_size=...) 指定截图尺寸时, 按视口比例和 SCREENSHOT_MAX_WIDTH
+    设置 llm_screenshot_size, browser_use 的工具据此把 LLM 给出的坐标换算回视口坐标。
+    """
+
+    _screenshot_pipeline: ScreenshotPipeline = PrivateAttr(default_factory=ScreenshotPipeline)
+    _auto_llm_screenshot_size: bool = PrivateAttr(default=False)
+
+    def _resolve_llm_screenshot_size(self, viewport: Tuple[Optional[int], Optional[int]]) -> Optional[Tuple[int, int]]:
+        if self.llm_screenshot_size and not self._auto_llm_screenshot_size:
+            # Agent 指定的尺寸: 缩放到相同大小, browser_use 不会再次缩放
+            return tuple(self.llm_screenshot_size)
+
+        size = self._screenshot_pipeline.llm_size(viewport) if viewport[0] and viewport[1] else None
+        self.llm_screenshot_size = size
+        self._auto_llm_screenshot_size = True
+        return size
+
+    async def _compress_summary(self, summary: Any) -> Any:
+        screenshot = getattr(summary, "screenshot", None)
+        if Image is None or not screenshot:
+            return summary
+
+        page_info = getattr(summary, "page_info", None)
+        viewport = (
+            getattr(page_info, "viewport_width", None),
+            getattr(page_info, "viewport_height", None),
+        )
+        try:
+            summary.screenshot = await asyncio.to_thread(
+                self._screenshot_pipeline.compress_for_llm,
+                screenshot,
+                viewport,
+                self._resolve_llm_screenshot_size(viewport),
+            )
+        except (OSError, ValueError) as e:
+            logger.warning("screenshot_compress_failed", extra={"fields": {"error": str(e)}})
+            if self._auto_llm_screenshot_size:
+                # 原图没有缩放, 坐标不需要换算
+                self.llm_screenshot_size = None
+        return summary
+
+    # 不同版本的 browser_use 使用不同的方法名获取浏览器状态
+    async def get_browser_state_summary(self, *args, **kwargs):
+        return await self._compress_summary(await super().get_browser_state_summary(*args, **kwargs))
+
+    async def get_state_summary(self, *args, **kwargs):
+        return await self._compress_summary(await super().get_state_summary(*args, **kwargs))
+
+def archive_history(history_data: Dict[str, Any], history_dir: str) -> str:
+    """
+    压缩保存 Agent 的执行历史。
+
+    历史中的截图 (browser_use 写在临时目录中的 screenshot_path 文件, 以及旧版本的 base64
+    screenshot 字段) 被替换为 frames/ 目录下的 WebP/JPEG 文件引用, 感知哈希相同的帧
+    只保存一份; 历史 JSON 和 browser_use 保存的对话记录都使用 gzip 压缩。
+
+    Args:
+        history_data (Dict[str, Any]): AgentHistoryList.model_dump() 的结果。
+        history_dir (str): 本次任务的历史记录目录。
+
+    Returns:
+        str: 压缩后的历史 JSON 文件路径。
+    """
+    frames_dir = os.path.join(history_dir, "frames")
+    os.makedirs(frames_dir, exist_ok=True)
+    pipeline = ScreenshotPipeline()
+    frames: Dict[int, str] = {}
+
+    def store_frame(screenshot: str) -> str:
+        image, _ = pipeline.prepare(screenshot)
+        if image.width > pipeline.max_width:
+            image = image.resize(
+                (pipeline.max_width, round(image.height * pipeline.max_width / image.width)),
+                Image.LANCZOS,
+            )
+        frame_hash = pipeline.perceptual_hash(image)
+        for known_hash, frame_name in frames.items():
+            if pipeline.is_duplicate(frame_hash, known_hash):
+                return frame_name
+
+        frame_name = f"frames/{frame_hash:016x}.{'jpg' if pipeline.image_format == 'jpeg' else 'webp'}"
+        with open(os.path.join(history_dir, frame_name), "wb") as f:
+            f.write(pipeline.encode_frame(image))
+        frames[frame_hash] = frame_name
+        return frame_name
+
+    def store_frame_file(screenshot_path: str) -> str:
+        try:
+            with open(screenshot_path, "rb") as f:
+                return store_frame(base64.b64encode(f.read()).decode())
+        except OSError:
+            # browser_use 的临时目录已被清理时保留原路径
+            return screenshot_path
+
+    def replace_screenshot(key: str, value: Any) -> Any:
+        if key == "screenshot" and isinstance(value, str) and value:
+            return store_frame(value)
+        if key == "screenshot_path" and isinstance(value, str) and value:
+            return store_frame_file(value)
+        return replace_screenshots(value)
+
+    def replace_screenshots(obj: Any) -> Any:
+        if isinstance(obj, dict):
+            return {k: replace_screenshot(k, v) for k, v in obj.items()}
+        elif isinstance(obj, list):
+            return [replace_screenshots(item) for item in obj]
+        return obj
+
+    if Image is not None:
+        history_data = replace_screenshots(history_data)
+
+    # 压缩 browser_use 保存的对话记录
+    for path in pathlib.Path(history_dir).iterdir():
+        if path.is_file() and path.suffix != ".gz":
+            with open(path, "rb") as src, gzip.open(f"{path}.gz", "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            path.unlink()
+
+    history_path = os.path.join(history_dir, "history.json.gz")
+    with gzip.open(history_path, "wt", encoding="utf-8") as f:
+        json.dump(history_data, f, ensure_ascii=False, default=str)
+    return history_path
+
+def parse_tiktok_media_url(raw_data: str) -> Optional[str]:
+    """
+    从 TikTok 页面内嵌的 __UNIVERSAL_DATA_FOR_REHYDRATION__ JSON 中取出视频地址。
+
+    Args:
+        raw_data (str): script 标签中的 JSON 文本。
+
+    Returns:
+        Optional[str]: 视频地址, 优先使用无水印的 playAddr, 找不到时返回 None。
+    """
+    data = json.loads(raw_data)
+    video = (
+        data.get("__DEFAULT_SCOPE__", {})
+        .get("webapp.video-detail", {})
+        .get("itemInfo", {})
+        .get("itemStruct", {})
+        .get("video", {})
+    )
+    return video.get("playAddr") or video.get("downloadAddr") or None
+
+async def extract_tiktok_media(context: BrowserContext, video_url: str) -> str:
+    """
+    打开 TikTok 视频页面, 从内嵌 JSON 中提取视频地址; 页面没有内嵌数据时,
+    退而使用页面加载过程中出现的视频网络响应。
+
+    Args:
+        context (BrowserContext): 浏览器上下文, 用于共享登录状态和 cookies。
+        video_url (str): TikTok 视频页面地址。
+
+    Returns:
+        str: 视频文件的直链。
+
+    Raises:
+        RuntimeError: 页面中找不到视频地址时。
+    """
+    page = await context.new_page()
+    media_urls: List[str] = []
+    page.on(
+        "response",
+        lambda response: media_urls.append(response.url)
+        if response.headers.get("content-type", "").startswith("video/") else None,
+    )
+    try:
+        await page.goto(video_url, wait_until="domcontentloaded")
+        await check_human_required(page)
+
+        rehydration = page.locator("#__UNIVERSAL_DATA_FOR_REHYDRATION__")
+        if await rehydration.count():
+            media_url = parse_tiktok_media_url(await rehydration.text_content())
+            if media_url:
+                return media_url
+
+        if not media_urls:
+            response = await page.wait_for_event(
+                "response",
+                predicate=lambda response: response.headers.get("content-type", "").startswith("video/"),
+                timeout=15000,
+            )
+            media_urls.append(response.url)
+        return media_urls[0]
+    except PlaywrightError as e:
+        raise RuntimeError(f"无法提取视频地址: {e}") from e
+    finally:
+        await page.close()
+
+async def stream_to_file(client: httpx.AsyncClient, url: str, save_file_path: str) -> None:
+    """
+    以流的方式下载文件, 先写入 .part 临时文件, 完成后再重命名, 避免留下不完整的文件。
+    """
+    temp_path = f"{save_file_path}.part"
+    try:
+        async with client.stream("GET", url) as response:
+            response.raise_for_status()
+            with open(temp_path, "wb") as f:
+                async for chunk in response.aiter_bytes(1024 * 1024):
+                    f.write(chunk)
+        os.replace(temp_path, save_file_path)
+    except BaseException:
+        # 下载失败或被取消时删除不完整的临时文件
+        with contextlib.suppress(OSError):
+            os.remove(temp_path)
+        raise
+
 @mcp.tool
 async def login_hailuoai(
     iphone: str = Field(
@@ -152,26 +1817,24 @@ async def text_to_image(
         1, 
         description="单步动作等待的时长"
     ),
+    mode: Optional[ExecutionMode] = Field(
+        None,
+        description="执行模式: auto(优先无头, 受阻或需要人工时回退到有头浏览器), headless, headed。留空时使用 BROWSER_MODE 环境变量"
+    ),
+    prefetch: Optional[bool] = Field(
+        None,
+        description="生成完成后是否在后台自动下载无水印结果, 之后调用 download_video 会立即返回。留空时使用 PREFETCH_ENABLED 环境变量"
+    ),
+    force: bool = Field(
+        False,
+        description="为 true 时忽略去重窗口, 即使相同参数的任务刚刚提交过也重新提交"
+    ),
 ):
     """文生图"""
-    async with async_playwright() as p:
-        # Connect to the remote Chrome instance via its CDP endpoint
-        browser = await p.chromium.connect_over_cdp("http://localhost:9222") # Replace with the remote host and port
-
-        if not browser.contexts:
-            raise RuntimeError("No browser contexts found.")
-        
-        # Access the default browser context
-        context = browser.contexts[0] 
-
-        if not context.pages:
-            raise RuntimeError("No pages available in context.")
-        
-        # Access the first page within the default context
-        page = context.pages[0] 
-        
+    async def flow(page: Page) -> Dict[str, Any]:
         # 进入页面
         await page.goto("https://hailuoai.com/create?type=image")
+        await check_human_required(page)
         await random_wait(wait_number=wait_number)
 
         # 将数量改为1张
@@ -192,6 +1855,7 @@ async def text_to_image(
 
         # 点击视频生成
         await page.get_by_role("button", name="AI Video create png by Hailuo").click()
+        mark_submitted()
         await random_wait(wait_number=wait_number)
 
         # 清除输入框中的内容
@@ -210,11 +1874,20 @@ async def text_to_image(
         is_visible = await page.get_by_text(text[:9]).first.is_visible();
         await random_wait(wait_number=wait_number)
 
-        # 关闭浏览器
-        await browser.close()
-    return {
-        "is_visible": is_visible
-    }
+        return {
+            "is_visible": is_visible
+        }
+
+    return await run_job(
+        "text_to_image",
+        {"text": text, "ratio": ratio},
+        flow,
+        mode,
+        prompt=text,
+        work_type="图片",
+        prefetch=prefetch,
+        force=force,
+    )
 
 
 @mcp.tool
@@ -229,26 +1902,24 @@ async def image_to_video(
         1, 
         description="单步动作等待的时长"
     ),
+    mode: Optional[ExecutionMode] = Field(
+        None,
+        description="执行模式: auto(优先无头, 受阻或需要人工时回退到有头浏览器), headless, headed。留空时使用 BROWSER_MODE 环境变量"
+    ),
+    prefetch: Optional[bool] = Field(
+        None,
+        description="生成完成后是否在后台自动下载无水印结果, 之后调用 download_video 会立即返回。留空时使用 PREFETCH_ENABLED 环境变量"
+    ),
+    force: bool = Field(
+        False,
+        description="为 true 时忽略去重窗口, 即使相同参数的任务刚刚提交过也重新提交"
+    ),
 ):
     """图生视频"""
-    async with async_playwright() as p:
-        # Connect to the remote Chrome instance via its CDP endpoint
-        browser = await p.chromium.connect_over_cdp("http://localhost:9222") # Replace with the remote host and port
-
-        if not browser.contexts:
-            raise RuntimeError("No browser contexts found.")
-        
-        # Access the default browser context
-        context = browser.contexts[0] 
-
-        if not context.pages:
-            raise RuntimeError("No pages available in context.")
-        
-        # Access the first page within the default context
-        page = context.pages[0] 
-        
+    async def flow(page: Page) -> Dict[str, Any]:
         # 进入页面
         await page.goto("https://hailuoai.com/create?type=video")
+        await check_human_required(page)
         await expect(page.locator(".common-create-form-container").get_by_text("图生视频")).to_be_visible(timeout=5000)
         await random_wait(wait_number=wait_number)
 
@@ -281,6 +1952,7 @@ async def image_to_video(
 
         # 点击视频生成
         await page.get_by_role("button", name="AI Video create png by Hailuo").click()
+        mark_submitted()
         await random_wait(wait_number=wait_number)
 
         # 清除输入框中的内容
@@ -299,11 +1971,20 @@ async def image_to_video(
         is_visible = await page.get_by_text(text[:9]).first.is_visible();
         await random_wait(wait_number=wait_number)
 
-        # 关闭浏览器
-        await browser.close()
-    return {
-        "is_visible": is_visible
-    }
+        return {
+            "is_visible": is_visible
+        }
+
+    return await run_job(
+        "image_to_video",
+        {"text": text, "image_path": image_path},
+        flow,
+        mode,
+        prompt=text,
+        work_type="视频",
+        prefetch=prefetch,
+        force=force,
+    )
 
 
 @mcp.tool
@@ -318,26 +1999,24 @@ async def text_to_video(
         1, 
         description="单步动作等待的时长"
     ),
+    mode: Optional[ExecutionMode] = Field(
+        None,
+        description="执行模式: auto(优先无头, 受阻或需要人工时回退到有头浏览器), headless, headed。留空时使用 BROWSER_MODE 环境变量"
+    ),
+    prefetch: Optional[bool] = Field(
+        None,
+        description="生成完成后是否在后台自动下载无水印结果, 之后调用 download_video 会立即返回。留空时使用 PREFETCH_ENABLED 环境变量"
+    ),
+    force: bool = Field(
+        False,
+        description="为 true 时忽略去重窗口, 即使相同参数的任务刚刚提交过也重新提交"
+    ),
 ):
     """文生视频"""
-    async with async_playwright() as p:
-        # Connect to the remote Chrome instance via its CDP endpoint
-        browser = await p.chromium.connect_over_cdp("http://localhost:9222") # Replace with the remote host and port
-
-        if not browser.contexts:
-            raise RuntimeError("No browser contexts found.")
-        
-        # Access the default browser context
-        context = browser.contexts[0] 
-
-        if not context.pages:
-            raise RuntimeError("No pages available in context.")
-        
-        # Access the first page within the default context
-        page = context.pages[0] 
-        
+    async def flow(page: Page) -> Dict[str, Any]:
         # 进入页面
         await page.goto("https://hailuoai.com/create?type=video")
+        await check_human_required(page)
         await expect(page.get_by_text('文生视频')).to_be_visible(timeout=5000)
         await random_wait(wait_number=wait_number)
 
@@ -364,17 +2043,27 @@ async def text_to_video(
 
         # 点击视频生成
         await page.get_by_role("button", name="AI Video create png by Hailuo").click()
+        mark_submitted()
         await random_wait(wait_number=wait_number)
 
         # 获取页面元素内容
         is_visible = await page.get_by_text(val_text).first.is_visible();
         await random_wait(wait_number=wait_number)
 
-        # 关闭浏览器
-        await browser.close()
-    return {
-        "is_visible": is_visible
-    }
+        return {
+            "is_visible": is_visible
+        }
+
+    return await run_job(
+        "text_to_video",
+        {"text": text},
+        flow,
+        mode,
+        prompt=text,
+        work_type="视频",
+        prefetch=prefetch,
+        force=force,
+    )
 
 
 @mcp.tool
@@ -392,26 +2081,20 @@ async def heygen_image_to_video(
         1, 
         description="单步动作等待的时长"
     ),
+    mode: Optional[ExecutionMode] = Field(
+        None,
+        description="执行模式: auto(优先无头, 受阻或需要人工时回退到有头浏览器), headless, headed。留空时使用 BROWSER_MODE 环境变量"
+    ),
+    force: bool = Field(
+        False,
+        description="为 true 时忽略去重窗口, 即使相同参数的任务刚刚提交过也重新提交"
+    ),
 ):
     """heygen图生视频"""
-    async with async_playwright() as p:
-        # Connect to the remote Chrome instance via its CDP endpoint
-        browser = await p.chromium.connect_over_cdp("http://localhost:9222") # Replace with the remote host and port
-
-        if not browser.contexts:
-            raise RuntimeError("No browser contexts found.")
-        
-        # Access the default browser context
-        context = browser.contexts[0] 
-
-        if not context.pages:
-            raise RuntimeError("No pages available in context.")
-        
-        # Access the first page within the default context
-        page = context.pages[0] 
-        
+    async def flow(page: Page) -> Dict[str, Any]:
         # 进入页面
         await page.goto("https://app.heygen.com/home")
+        await check_human_required(page)
         await random_wait(wait_number=wait_number)
 
         # 点击图生视频
@@ -433,7 +2116,7 @@ async def heygen_image_to_video(
             await page.locator('button:has(iconpark-icon[name="portrait-phone"])').click()
             await random_wait(wait_number=wait_number)
         except TimeoutError:
-            print("未找到指定的按钮或操作超时，跳过此步骤。")
+            logger.info("step_skipped", extra={"fields": {"step": "portrait_mode", "reason": "timeout"}})
         
         # 上传音频
         await page.get_by_text("upload or record audio").click()
@@ -461,6 +2144,7 @@ async def heygen_image_to_video(
 
         # 点击视频生成
         await page.locator("div").filter(has_text=re.compile(r"^Generate video$")).click()
+        mark_submitted()
         await random_wait(wait_number=wait_number)
 
         # 切换视频列表
@@ -483,11 +2167,18 @@ async def heygen_image_to_video(
         # await page.get_by_role("menuitem", name="Get Video ID").click()
         # video_id = await page.evaluate("navigator.clipboard.readText()")
 
-        # 关闭浏览器
-        await browser.close()
-    return {
-        "current_url": current_url
-    }
+        return {
+            "current_url": current_url
+        }
+
+    return await run_job(
+        "heygen_image_to_video",
+        {"text": text, "image_path": image_path, "audio_path": audio_path},
+        flow,
+        mode,
+        prompt=text,
+        force=force,
+    )
 
 
 @mcp.tool
@@ -503,26 +2194,16 @@ async def heygen_download_video(
         1, 
         description="单步动作等待的时长"
     ),
+    mode: Optional[ExecutionMode] = Field(
+        None,
+        description="执行模式: auto(优先无头, 受阻或需要人工时回退到有头浏览器), headless, headed。留空时使用 BROWSER_MODE 环境变量"
+    ),
 ):
     """heygen下载视频"""
-    async with async_playwright() as p:
-        # Connect to the remote Chrome instance via its CDP endpoint
-        browser = await p.chromium.connect_over_cdp("http://localhost:9222") # Replace with the remote host and port
-
-        if not browser.contexts:
-            raise RuntimeError("No browser contexts found.")
-        
-        # Access the default browser context
-        context = browser.contexts[0] 
-
-        if not context.pages:
-            raise RuntimeError("No pages available in context.")
-        
-        # Access the first page within the default context
-        page = context.pages[0] 
-        
+    async def flow(page: Page) -> Dict[str, Any]:
         # 进入页面
         await page.goto(download_url)
+        await check_human_required(page)
         await random_wait(wait_number=wait_number)
 
         # 打开下载链接
@@ -541,11 +2222,15 @@ async def heygen_download_video(
         await download.save_as(save_path)
         await random_wait(wait_number=wait_number)
 
-        # 关闭浏览器
-        await browser.close()
-    return {
-        "filePath": save_path
-    }
+        return {
+            "filePath": save_path
+        }
+
+    return await result_cache.run(
+        cache_key("heygen_download_video", normalize_url(download_url), os.path.abspath(save_path)),
+        lambda: run_flow("heygen_download_video", flow, mode),
+        lambda result: result["filePath"],
+    )
 
 
 @mcp.tool
@@ -565,68 +2250,25 @@ async def download_video(
         1, 
         description="单步动作等待的时长"
     ),
+    mode: Optional[ExecutionMode] = Field(
+        None,
+        description="执行模式: auto(优先无头, 受阻或需要人工时回退到有头浏览器), headless, headed。留空时使用 BROWSER_MODE 环境变量"
+    ),
 ):
     """下载视频"""
-    async with async_playwright() as p:
-        # Connect to the remote Chrome instance via its CDP endpoint
-        browser = await p.chromium.connect_over_cdp("http://localhost:9222") # Replace with the remote host and port
-
-        if not browser.contexts:
-            raise RuntimeError("No browser contexts found.")
-        
-        # Access the default browser context
-        context = browser.contexts[0] 
-
-        if not context.pages:
-            raise RuntimeError("No pages available in context.")
-        
-        # Access the first page within the default context
-        page = context.pages[0] 
-        
-        # 进入页面
-        await page.goto("https://hailuoai.com/create?type=video")
-        await expect(page.get_by_text('文生视频')).to_be_visible(timeout=5000)
-        await random_wait(wait_number=wait_number)
-
-        # 点击右边的类型
-        await page.get_by_text('类型:').click();
-        await random_wait(wait_number=wait_number)
-        
-        # 选择显示类型
-        await page.get_by_role("option", name=type_of_work).click()
-        await random_wait(wait_number=wait_number)
-
-        # 定位到指定视频的弹出层
-        await page.locator("#preview-video-scroll-container div").filter(has_text=text).nth(2).click()
-        await random_wait(wait_number=wait_number)
-
-        # 将鼠标移动到指定位置, 并单击
-        if type_of_work == "图片":
-            await page.get_by_role("main").filter(has_text=f"创意描述复制{text}").get_by_role("button").nth(1).click()
-        elif type_of_work == "视频":
-            await page.locator(".mt-auto > .pointer-events-auto > button").first.click()
-        await random_wait(wait_number=wait_number)
-
-        # 验证无水印按钮是否存在
-        element_to_check = page.get_by_role("menuitem", name="无水印").locator("div")
-        await expect(element_to_check).to_be_visible()
-        await random_wait(wait_number=wait_number)
-
-        # 下载视频
-        async with page.expect_download() as download_info:
-            await element_to_check.click()
-        download = await download_info.value
-        
-        # 将下载文件保存到指定路径
-        suggested_filename = download.suggested_filename
-        save_file_path = os.path.join(download_path, suggested_filename)
-        await download.save_as(save_file_path)
-        await random_wait(wait_number=wait_number)
-
-        await browser.close()
-    return {
-        "filePath": download.suggested_filename
-    }
+    async def flow(page: Page) -> Dict[str, Any]:
+        return await hailuo_download_flow(page, text, type_of_work, download_path, wait_number)
+
+    # 结果已经由预取器 (或之前的下载) 保存到本地时直接返回
+    prefetched = await find_downloaded_result(text, type_of_work, download_path)
+    if prefetched is not None:
+        return prefetched
+
+    return await result_cache.run(
+        cache_key("download_video", " ".join(text.split()), type_of_work, os.path.abspath(download_path)),
+        lambda: run_flow("download_video", flow, mode),
+        lambda result: os.path.join(download_path, result["filePath"]),
+    )
 
 
 @mcp.tool
@@ -646,26 +2288,16 @@ async def download_tiktok_video(
         1, 
         description="单步动作等待的时长"
     ),
+    mode: Optional[ExecutionMode] = Field(
+        None,
+        description="执行模式: auto(优先无头, 受阻或需要人工时回退到有头浏览器), headless, headed。留空时使用 BROWSER_MODE 环境变量"
+    ),
 ):
     """下载tiktok视频"""
-    async with async_playwright() as p:
-        # Connect to the remote Chrome instance via its CDP endpoint
-        browser = await p.chromium.connect_over_cdp("http://localhost:9222") # Replace with the remote host and port
-
-        if not browser.contexts:
-            raise RuntimeError("No browser contexts found.")
-        
-        # Access the default browser context
-        context = browser.contexts[0] 
-
-        if not context.pages:
-            raise RuntimeError("No pages available in context.")
-        
-        # Access the first page within the default context
-        page = context.pages[0] 
-        
+    async def flow(page: Page) -> Dict[str, Any]:
         # 进入页面
         await page.goto(video_url)
+        await check_human_required(page)
         await random_wait(wait_number=wait_number)
 
         # 点击视频暂停播放
@@ -694,11 +2326,99 @@ async def download_tiktok_video(
         await download.save_as(save_file_path)
         await random_wait(wait_number=wait_number)
 
-        await context.close()
-        await browser.close()
-    return {
-        "filePath": final_filename
-    }
+        return {
+            "filePath": final_filename
+        }
+
+    return await result_cache.run(
+        cache_key(
+            "download_tiktok_video",
+            normalize_url(video_url, drop_query=True),
+            os.path.abspath(download_path),
+            save_as_filename,
+        ),
+        lambda: run_flow("download_tiktok_video", flow, mode, close_context=True),
+        lambda result: os.path.join(download_path, result["filePath"]),
+    )
+
+
+@mcp.tool
+async def download_tiktok_videos(
+    video_urls: List[str] = Field(
+        description="需要下载的tiktok视频链接列表"
+    ),
+    download_path: str = Field(
+        "/root/file", 
+        description="下载文件保存路径, 文件名为视频ID"
+    ),
+    mode: Optional[ExecutionMode] = Field(
+        None,
+        description="执行模式: auto(优先无头, 受阻或需要人工时回退到有头浏览器), headless, headed。留空时使用 BROWSER_MODE 环境变量"
+    ),
+):
+    """批量下载tiktok视频: 从页面数据中提取视频直链, 并发下载到本地"""
+    # 去重并保持原有顺序
+    unique_urls = list(dict.fromkeys(url.strip() for url in video_urls if url.strip()))
+    os.makedirs(download_path, exist_ok=True)
+
+    async def flow(page: Page) -> Dict[str, Any]:
+        context = page.context
+        page_semaphore = asyncio.Semaphore(TIKTOK_PAGE_CONCURRENCY)
+        # 在进入连接池之前限制并发下载数, 排队的下载不会因为等待连接超时而失败
+        download_semaphore = asyncio.Semaphore(TIKTOK_DOWNLOAD_CONCURRENCY)
+        user_agent = await page.evaluate("navigator.userAgent")
+
+        async with httpx.AsyncClient(
+            headers={"User-Agent": user_agent, "Referer": "https://www.tiktok.com/"},
+            limits=httpx.Limits(max_connections=TIKTOK_DOWNLOAD_CONCURRENCY),
+            timeout=httpx.Timeout(30.0, read=120.0, pool=None),
+            follow_redirects=True,
+        ) as client:
+
+            async def download_one(video_url: str) -> Dict[str, Any]:
+                async with page_semaphore:
+                    media_url = await extract_tiktok_media(context, video_url)
+                    # 视频直链需要带上访问页面时下发的 cookies
+                    for cookie in await context.cookies(media_url):
+                        client.cookies.set(cookie["name"], cookie["value"], domain=cookie["domain"], path=cookie["path"])
+
+                video_id = re.search(r"/video/(\d+)", video_url)
+                final_filename = f"{video_id.group(1) if video_id else uuid.uuid4().hex}.mp4"
+                async with download_semaphore:
+                    await stream_to_file(client, media_url, os.path.join(download_path, final_filename))
+                return {"filePath": final_filename}
+
+            async def download_cached(video_url: str) -> Dict[str, Any]:
+                try:
+                    result = await result_cache.run(
+                        cache_key(
+                            "download_tiktok_videos",
+                            normalize_url(video_url, drop_query=True),
+                            os.path.abspath(download_path),
+                        ),
+                        lambda: download_one(video_url),
+                        lambda result: os.path.join(download_path, result["filePath"]),
+                    )
+                    return {"videoUrl": video_url, **result, "error": None}
+                except HumanRequiredError as e:
+                    logger.warning("tiktok_download_blocked", extra={"fields": {"video_url": video_url, "error": str(e)}})
+                    return {"videoUrl": video_url, "filePath": None, "error": str(e), "blocked": True}
+                except (RuntimeError, ValueError, PlaywrightError, httpx.HTTPError, OSError) as e:
+                    logger.warning("tiktok_download_failed", extra={"fields": {"video_url": video_url, "error": str(e)}})
+                    return {"videoUrl": video_url, "filePath": None, "error": str(e)}
+
+            results = await asyncio.gather(*(download_cached(url) for url in unique_urls))
+
+        # 无头路径下全部失败且有页面被拦截时, 交给 run_flow 回退到有头浏览器
+        blocked = [result.pop("blocked", False) for result in results]
+        if results and all(result["error"] for result in results) and any(blocked) and flow_attempt.get(None) is not None:
+            raise HumanRequiredError(f"全部视频提取失败: {results[0]['error']}")
+
+        return {
+            "results": results
+        }
+
+    return await run_flow("download_tiktok_videos", flow, mode)
 
 
 @mcp.tool
@@ -811,6 +2531,8 @@ async def run_task(
         model_kwargs=model_kwargs
     )
 
+    history_dir = os.path.join(HISTORY_DIR, task_id)
+
     async with async_playwright() as p:
         try:
             base_profile = BrowserProfile(
@@ -822,48 +2544,55 @@ async def run_task(
                 # wait_between_actions=0.3
             )
             
-            browser_session = BrowserSession(
-                cdp_url='http://localhost:9222',
-                id=f"session-{session_id}"
-            )
-
-            # await browser_session.start()
-
-            # all_pages = browser_session.tabs
-            # target_page = all_pages[0]
-
-            # if not target_page:
-            #     print("⚠️ 浏览器中没有现有页面，创建了一个新页面。")
-            #     target_page = await browser_session.browser_context.new_page()
-            #     if browser_session.browser_profile.viewport:
-            #         await target_page.set_viewport_size(browser_session.browser_profile.viewport)
-
-            # if target_page != browser_session.agent_current_page:
-            #     target_page_index = browser_session.tabs.index(target_page)
-            #     await browser_session.switch_tab(target_page_index)
-            #     print(f"✅ Agent 切换到 tab 索引 {target_page_index}, URL: {browser_session.agent_current_page.url}")
-            # else:
-            #     await browser_session.agent_current_page.bring_to_front()
-            #     print(f"✅ Agent 已经在目标页面, URL: {browser_session.agent_current_page.url}")
-
-            agent = Agent(
-                task_id=task_id,
-                task=task, 
-                llm=llm,
-                # page=page,
-                # browser_context=context,
-                # browser=browser,
-                browser_profile=base_profile,
-                browser_session=browser_session,
-                use_vision=True,
-                max_actions_per_step=3,
-                retry_delay=4,
-                save_conversation_path="/root/output/history"
-            )
-
-            history = await agent.run(max_steps=max_steps)
+            # Agent 运行期间一直持有有头浏览器的租约, 与 Playwright 流程和其他工作进程互斥
+            async with browser_pool.lease("headed") as cdp_url:
+                browser_session = CompressingBrowserSession(
+                    cdp_url=cdp_url,
+                    id=f"session-{session_id}"
+                )
+
+                # await browser_session.start()
+
+                # all_pages = browser_session.tabs
+                # target_page = all_pages[0]
+
+                # if not target_page:
+                #     print("⚠️ 浏览器中没有现有页面，创建了一个新页面。")
+                #     target_page = await browser_session.browser_context.new_page()
+                #     if browser_session.browser_profile.viewport:
+                #         await target_page.set_viewport_size(browser_session.browser_profile.viewport)
+
+                # if target_page != browser_session.agent_current_page:
+                #     target_page_index = browser_session.tabs.index(target_page)
+                #     await browser_session.switch_tab(target_page_index)
+                #     print(f"✅ Agent 切换到 tab 索引 {target_page_index}, URL: {browser_session.agent_current_page.url}")
+                # else:
+                #     await browser_session.agent_current_page.bring_to_front()
+                #     print(f"✅ Agent 已经在目标页面, URL: {browser_session.agent_current_page.url}")
+
+                agent = Agent(
+                    task_id=task_id,
+                    task=task, 
+                    llm=llm,
+                    # page=page,
+                    # browser_context=context,
+                    # browser=browser,
+                    browser_profile=base_profile,
+                    browser_session=browser_session,
+                    use_vision=True,
+                    max_actions_per_step=3,
+                    retry_delay=4,
+                    save_conversation_path=history_dir
+                )
+
+                history = await agent.run(max_steps=max_steps)
             final_agent_result = history.final_result()
 
+            try:
+                await asyncio.to_thread(archive_history, history.model_dump(), history_dir)
+            except (OSError, ValueError) as e:
+                logger.warning("history_archive_failed", extra={"fields": {"error": str(e)}})
+
             final_output_json = json.dumps(final_agent_result, ensure_ascii=False, indent=2) if final_agent_result is not None else None
             
             return Result(
@@ -871,11 +2600,100 @@ async def run_task(
                 final_output=final_output_json,
             )
         except Exception as e:
+            logger.exception("agent_run_failed")
             return Result(
                 status=0,
                 error_message=f"Error during browser task execution: {e}",
             )
 
 
+def run_worker(sock: socket.socket, worker_index: int) -> None:
+    """
+    工作进程入口: 在共享的监听 socket 上运行无状态的 streamable HTTP MCP 服务。
+    """
+    import uvicorn
+
+    global logger, _jobs_reconciled
+    # fork 后日志后台线程不会被继承, 需要重新创建
+    logger = setup_logging()
+    log_context.set({"worker": worker_index})
+    # 任务核对由主进程统一发起, 避免工作进程重启时误判其它进程中正在执行的任务
+    _jobs_reconciled = True
+
+    app = mcp.http_app(transport="http", stateless_http=True)
+    server = uvicorn.Server(uvicorn.Config(app, log_level=logging.getLevelName(logger.level).lower()))
+    server.run(sockets=[sock])
+
+def run_reconcile() -> None:
+    """一次性进程入口: 核对上一次运行中未完成的任务。"""
+    global logger
+    logger = setup_logging()
+    asyncio.run(reconcile_jobs())
+
+def serve_workers(host: str, port: int, workers: int) -> None:
+    """
+    多进程模式: 启动浏览器池管理进程和多个 MCP 工作进程, 工作进程共享同一个监听端口。
+
+    DOM 处理、截图和 JSON 序列化等 CPU 密集的工作分散到多个核心上, 浏览器则由
+    管理进程集中调度。工作进程意外退出时会被自动重启。
+
+    Args:
+        host (str): 监听地址。
+        port (int): 监听端口。
+        workers (int): 工作进程数量。
+    """
+    global BROWSER_POOL_AUTHKEY
+    fork_context = multiprocessing.get_context("fork")
+
+    # 随机生成 IPC 密钥, 管理进程和工作进程都由本进程 fork, 会继承该密钥
+    BROWSER_POOL_AUTHKEY = os.urandom(32)
+    pool_manager = BrowserPoolManager(address=("127.0.0.1", 0), authkey=BROWSER_POOL_AUTHKEY, ctx=fork_context)
+    pool_manager.start()
+    pool_host, pool_port = pool_manager.address
+    browser_pool.address = f"{pool_host}:{pool_port}"
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+
+    def start_worker(index: int) -> multiprocessing.Process:
+        process = fork_context.Process(target=run_worker, args=(sock, index), daemon=True)
+        process.start()
+        return process
+
+    processes = [start_worker(index) for index in range(workers)]
+    fork_context.Process(target=run_reconcile, daemon=True).start()
+    logger.info("workers_started", extra={"fields": {"host": host, "port": port, "workers": workers, "browser_pool": browser_pool.address}})
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while not stopping:
+        for index, process in enumerate(processes):
+            if not process.is_alive():
+                logger.warning("worker_restarted", extra={"fields": {"worker": index, "exitcode": process.exitcode}})
+                processes[index] = start_worker(index)
+        time.sleep(1)
+
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join(timeout=10)
+    pool_manager.shutdown()
+    sock.close()
+
+
 if __name__ == "__main__":
-    mcp.run()
+    mcp_workers = int(os.getenv("MCP_WORKERS", "1"))
+    if mcp_workers > 1:
+        serve_workers(os.getenv("MCP_HOST", "0.0.0.0"), int(os.getenv("MCP_PORT", "8000")), mcp_workers)
+    else:
+        mcp.run()
@@ -0,0 +1,647 @@
+#!/usr/bin/env python
+"""
+MCP 服务的负载测试与长时间稳定性 (soak) 测试。
+
+在本机启动一个模拟站点 (TikTok 视频页、HeyGen 下载页和视频文件), 打开 N 个并发的 MCP 会话,
+按权重混合调用工具, 持续运行指定时长, 最后输出一份 JSON 报告:
+吞吐量、各工具的延迟分位数、错误率、服务进程和 Chrome 的内存增长。
+报告可以用 compare 子命令在两个版本之间对比。
+
+用法:
+    # 20 个 SSE 会话, 运行 4 小时
+    python script/load_test.py run --clients 20 --duration 14400 --output report.json
+
+    # 多进程模式 (MCP_WORKERS > 1) 使用 streamable http
+    python script/load_test.py run --url http://127.0.0.1:8000/mcp --transport http
+
+    # 与上一个版本的报告对比, 有指标退化超过阈值时返回非 0 退出码
+    python script/load_test.py compare baseline.json report.json --max-regression 0.2
+
+服务和模拟站点不在同一个网络命名空间时 (例如服务运行在容器里), 用 --mock-base-url
+指定服务访问模拟站点时使用的地址。
+"""
+from typing import Optional, List, Dict, Any, Tuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import Counter, defaultdict
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import re
+import socket
+import sys
+import threading
+import time
+import uuid
+
+REPORT_SCHEMA_VERSION = 1
+
+# 默认的工具调用权重: 以浏览器工作为主, 夹杂少量只走 MCP 协议的 list_tools
+DEFAULT_MIX = "list_tools=1,download_tiktok_videos=3,heygen_download_video=2,download_tiktok_video=1"
+
+TIKTOK_PAGE = """<!DOCTYPE html>
+<html>
+<head><title>mock tiktok {video_id}</title></head>
+<body>
+<video src="/media/{video_id}.mp4" muted style="width:360px;height:640px;background:#000"></video>
+<section id="menu" hidden><div id="download">Download video</div></section>
+<script id="__UNIVERSAL_DATA_FOR_REHYDRATION__" type="application/json">{data}</script>
+<script>
+const video = document.querySelector("video");
+video.addEventListener("contextmenu", (event) => {{
+    event.preventDefault();
+    document.getElementById("menu").hidden = false;
+}});
+document.getElementById("download").addEventListener("click", () => {{
+    const link = document.createElement("a");
+    link.href = "/media/{video_id}.mp4?attachment=1";
+    link.download = "{video_id}.mp4";
+    link.click();
+}});
+</script>
+</body>
+</html>
+"""
+
+HEYGEN_PAGE = """<!DOCTYPE html>
+<html>
+<head><title>mock heygen {video_id}</title></head>
+<body>
+<button id="open">Download</button>
+<div role="dialog" aria-label="Download video" hidden>
+    <button id="download">Download</button>
+</div>
+<script>
+document.getElementById("open").addEventListener("click", () => {{
+    document.querySelector("[role=dialog]").hidden = false;
+}});
+document.getElementById("download").addEventListener("click", () => {{
+    const link = document.createElement("a");
+    link.href = "/media/{video_id}.mp4?attachment=1";
+    link.download = "{video_id}.mp4";
+    link.click();
+}});
+</script>
+</body>
+</html>
+"""
+
+
+class MockSiteHandler(BaseHTTPRequestHandler):
+    """
+    模拟站点:
+        /@loadtest/video/<id>  TikTok 视频页, 内嵌 __UNIVERSAL_DATA_FOR_REHYDRATION__ 并支持右键菜单下载
+        /heygen/<id>           HeyGen 分享页, Download 按钮打开下载对话框
+        /media/<id>.mp4        视频文件, 大小由 --media-bytes 决定
+    """
+    server_version = "MockSite/1.0"
+
+    def do_GET(self) -> None:
+        latency = self.server.latency
+        if latency:
+            time.sleep(latency)
+
+        path, _, query = self.path.partition("?")
+        if match := re.fullmatch(r"/@[\w.-]+/video/(\d+)", path):
+            video_id = match.group(1)
+            data = {
+                "__DEFAULT_SCOPE__": {
+                    "webapp.video-detail": {
+                        "itemInfo": {
+                            "itemStruct": {
+                                "id": video_id,
+                                "video": {"playAddr": f"{self.server.base_url}/media/{video_id}.mp4"},
+                            }
+                        }
+                    }
+                }
+            }
+            self.send_body(TIKTOK_PAGE.format(video_id=video_id, data=json.dumps(data)).encode(), "text/html; charset=utf-8")
+        elif match := re.fullmatch(r"/heygen/([\w-]+)", path):
+            self.send_body(HEYGEN_PAGE.format(video_id=match.group(1)).encode(), "text/html; charset=utf-8")
+        elif match := re.fullmatch(r"/media/([\w-]+)\.mp4", path):
+            headers = {}
+            if "attachment" in query:
+                headers["Content-Disposition"] = f'attachment; filename="{match.group(1)}.mp4"'
+            self.send_body(self.server.media, "video/mp4", headers)
+        else:
+            self.send_error(404)
+
+    def send_body(self, body: bytes, content_type: str, headers: Optional[Dict[str, str]] = None) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format: str, *args: Any) -> None:
+        # 长时间运行时访问日志没有意义, 只保留计数
+        self.server.requests += 1
+
+
+def start_mock_site(host: str, port: int, base_url: Optional[str], media_bytes: int, latency: float) -> ThreadingHTTPServer:
+    """在后台线程中启动模拟站点, 返回 HTTP server (base_url 属性为服务访问模拟站点的地址)。"""
+    httpd = ThreadingHTTPServer((host, port), MockSiteHandler)
+    httpd.daemon_threads = True
+    bound_host, bound_port = httpd.server_address[:2]
+    if bound_host in ("0.0.0.0", ""):
+        bound_host = socket.gethostbyname(socket.gethostname())
+    httpd.base_url = (base_url or f"http://{bound_host}:{bound_port}").rstrip("/")
+    # 文件头是 mp4 的 ftyp box, 其余填充随机字节, 避免被中间层压缩
+    httpd.media = (b"\x00\x00\x00\x18ftypmp42" + os.urandom(max(media_bytes - 12, 0)))[:max(media_bytes, 12)]
+    httpd.latency = latency
+    httpd.requests = 0
+    threading.Thread(target=httpd.serve_forever, name="mock-site", daemon=True).start()
+    return httpd
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    """解析 "tool=weight,tool=weight" 格式的调用权重。"""
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.strip().partition("=")
+        if name:
+            weights[name] = float(weight or 1)
+    if not weights or sum(weights.values()) <= 0:
+        raise ValueError(f"无效的调用权重: {mix}")
+    return weights
+
+
+class WorkloadGenerator:
+    """
+    生成工具调用参数。按 repeat_ratio 的概率复用已经请求过的视频 ID,
+    用来覆盖服务端的结果缓存和请求合并; 其余请求使用新的 ID, 确保真正触发浏览器工作。
+    """
+
+    def __init__(self, base_url: str, download_path: str, repeat_ratio: float, batch_size: int, mode: Optional[str]):
+        self.base_url = base_url
+        self.download_path = download_path
+        self.repeat_ratio = repeat_ratio
+        self.batch_size = batch_size
+        self.mode = mode
+        self.seen_ids: List[str] = []
+
+    def video_id(self) -> str:
+        if self.seen_ids and random.random() < self.repeat_ratio:
+            return random.choice(self.seen_ids)
+        video_id = str(random.randrange(10 ** 18, 10 ** 19))
+        self.seen_ids.append(video_id)
+        if len(self.seen_ids) > 1000:
+            self.seen_ids.pop(0)
+        return video_id
+
+    def arguments(self, tool: str) -> Dict[str, Any]:
+        mode = {"mode": self.mode} if self.mode else {}
+        if tool == "download_tiktok_videos":
+            return {
+                "video_urls": [f"{self.base_url}/@loadtest/video/{self.video_id()}" for _ in range(self.batch_size)],
+                "download_path": os.path.join(self.download_path, "tiktok_batch"),
+                **mode,
+            }
+        if tool == "download_tiktok_video":
+            return {
+                "video_url": f"{self.base_url}/@loadtest/video/{self.video_id()}",
+                "download_path": os.path.join(self.download_path, "tiktok"),
+                "wait_number": 0,
+                **mode,
+            }
+        if tool == "heygen_download_video":
+            video_id = self.video_id()
+            return {
+                "download_url": f"{self.base_url}/heygen/{video_id}",
+                "save_path": os.path.join(self.download_path, "heygen", f"{video_id}.mp4"),
+                "wait_number": 0,
+                **mode,
+            }
+        return {}
+
+
+def percentile(sorted_values: List[float], fraction: float) -> Optional[float]:
+    """最近秩法计算分位数, sorted_values 需已排序。"""
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(fraction * len(sorted_values)) - 1, 0)
+    return sorted_values[rank]
+
+
+def summarize_latencies(latencies: List[float], errors: int = 0) -> Dict[str, Any]:
+    """汇总一组延迟 (秒), 输出毫秒单位的分位数。"""
+    values = sorted(latencies)
+    count = len(values)
+
+    def ms(value: Optional[float]) -> Optional[float]:
+        return None if value is None else round(value * 1000, 2)
+
+    return {
+        "count": count,
+        "errors": errors,
+        "error_rate": round(errors / count, 6) if count else 0.0,
+        "mean_ms": ms(sum(values) / count) if count else None,
+        "p50_ms": ms(percentile(values, 0.50)),
+        "p90_ms": ms(percentile(values, 0.90)),
+        "p99_ms": ms(percentile(values, 0.99)),
+        "max_ms": ms(values[-1]) if values else None,
+    }
+
+
+def linear_slope(points: List[Tuple[float, float]]) -> Optional[float]:
+    """最小二乘法拟合 y = a + b x, 返回斜率 b; 少于两个点时返回 None。"""
+    if len(points) < 2:
+        return None
+    n = len(points)
+    mean_x = sum(x for x, _ in points) / n
+    mean_y = sum(y for _, y in points) / n
+    denominator = sum((x - mean_x) ** 2 for x, _ in points)
+    if denominator == 0:
+        return None
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / denominator
+
+
+def process_memory(pattern: re.Pattern) -> Optional[Dict[str, Any]]:
+    """
+    统计命令行匹配 pattern 的所有进程的内存 (MB)。优先使用 PSS (smaps_rollup),
+    Chrome 的多个进程共享大量内存页, 直接累加 RSS 会明显偏大。没有 /proc 时返回 None。
+    """
+    if not os.path.isdir("/proc"):
+        return None
+
+    own_pid = os.getpid()
+    total_kb = 0
+    pids = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit() or int(entry) == own_pid:
+            continue
+        try:
+            with open(f"/proc/{entry}/cmdline", "rb") as f:
+                cmdline = f.read().replace(b"\x00", b" ").decode(errors="replace")
+            if not cmdline or not pattern.search(cmdline):
+                continue
+            try:
+                with open(f"/proc/{entry}/smaps_rollup") as f:
+                    fields = dict(line.split(":", 1) for line in f if ":" in line)
+                memory_kb = int(fields["Pss"].split()[0])
+            except (OSError, KeyError, ValueError):
+                with open(f"/proc/{entry}/status") as f:
+                    fields = dict(line.split(":", 1) for line in f if ":" in line)
+                memory_kb = int(fields.get("VmRSS", "0 kB").split()[0])
+        except (OSError, ValueError):
+            # 进程在读取过程中退出
+            continue
+        total_kb += memory_kb
+        pids.append(int(entry))
+
+    return {"memory_mb": round(total_kb / 1024, 2), "processes": len(pids)}
+
+
+class Stats:
+    """收集调用结果, 同时维护全程统计和当前快照窗口的统计。"""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = Counter()
+        self.error_kinds: Counter = Counter()
+        self.window_latencies: List[float] = []
+        self.window_errors = 0
+        self.sessions_opened = 0
+        self.sessions_dropped = 0
+
+    def record(self, tool: str, latency: float, error_kind: Optional[str]) -> None:
+        self.latencies[tool].append(latency)
+        self.window_latencies.append(latency)
+        if error_kind:
+            self.errors[tool] += 1
+            self.error_kinds[f"{tool}:{error_kind}"] += 1
+            self.window_errors += 1
+
+    def take_window(self) -> Tuple[List[float], int]:
+        latencies, errors = self.window_latencies, self.window_errors
+        self.window_latencies, self.window_errors = [], 0
+        return latencies, errors
+
+
+def make_transport(url: str, transport: str):
+    from fastmcp.client.transports import SSETransport, StreamableHttpTransport
+
+    if transport == "sse":
+        return SSETransport(url)
+    return StreamableHttpTransport(url)
+
+
+def result_error(result: Any) -> Optional[str]:
+    """检查工具结果中的部分失败 (download_tiktok_videos 中单个视频失败)。"""
+    data = getattr(result, "structured_content", None)
+    if data is None:
+        content = getattr(result, "content", result)
+        for item in content if isinstance(content, list) else []:
+            try:
+                data = json.loads(getattr(item, "text", ""))
+                break
+            except (TypeError, ValueError):
+                continue
+    if isinstance(data, dict) and any(item.get("error") for item in data.get("results") or [] if isinstance(item, dict)):
+        return "partial_failure"
+    return None
+
+
+async def run_session(
+    index: int,
+    args: argparse.Namespace,
+    weights: Dict[str, float],
+    workload: WorkloadGenerator,
+    stats: Stats,
+    deadline: float,
+) -> None:
+    """单个 MCP 会话: 按权重循环调用工具直到截止时间, 连接断开时记录并重新连接。"""
+    from fastmcp import Client
+
+    tools, tool_weights = list(weights), list(weights.values())
+    # 分散各会话的启动时间, 避免同时建立连接
+    await asyncio.sleep(args.ramp_up * index / max(args.clients, 1))
+
+    while time.monotonic() < deadline:
+        try:
+            async with Client(make_transport(args.url, args.transport)) as client:
+                stats.sessions_opened += 1
+                while time.monotonic() < deadline:
+                    tool = random.choices(tools, tool_weights)[0]
+                    started = time.monotonic()
+                    error_kind = None
+                    session_error = None
+                    try:
+                        if tool == "list_tools":
+                            await asyncio.wait_for(client.list_tools(), args.call_timeout)
+                        else:
+                            result = await asyncio.wait_for(
+                                client.call_tool(tool, workload.arguments(tool)),
+                                args.call_timeout,
+                            )
+                            error_kind = result_error(result)
+                    except asyncio.TimeoutError:
+                        error_kind = "timeout"
+                    except Exception as e:
+                        # ToolError / McpError 是单次调用失败, 其他异常说明连接已经不可用
+                        error_kind = type(e).__name__
+                        if error_kind not in ("ToolError", "McpError"):
+                            session_error = e
+                    stats.record(tool, time.monotonic() - started, error_kind)
+                    if session_error is not None:
+                        raise session_error
+
+                    if args.think_time:
+                        await asyncio.sleep(random.uniform(0, args.think_time * 2))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            stats.sessions_dropped += 1
+            stats.error_kinds[f"session:{type(e).__name__}"] += 1
+            await asyncio.sleep(1)
+
+
+def memory_summary(samples: List[Tuple[float, Optional[Dict[str, Any]]]]) -> Optional[Dict[str, Any]]:
+    """由内存采样序列计算起止值、峰值、增长量和每小时增长斜率。"""
+    points = [(elapsed, sample["memory_mb"]) for elapsed, sample in samples if sample]
+    if not points:
+        return None
+    processes = [sample["processes"] for _, sample in samples if sample]
+    slope = linear_slope([(elapsed / 3600, memory) for elapsed, memory in points])
+    return {
+        "start_mb": points[0][1],
+        "end_mb": points[-1][1],
+        "peak_mb": max(memory for _, memory in points),
+        "growth_mb": round(points[-1][1] - points[0][1], 2),
+        "slope_mb_per_hour": None if slope is None else round(slope, 2),
+        "processes_start": processes[0],
+        "processes_end": processes[-1],
+        "processes_peak": max(processes),
+    }
+
+
+async def run_load_test(args: argparse.Namespace) -> Dict[str, Any]:
+    weights = parse_mix(args.mix)
+    mock_site = start_mock_site(args.mock_host, args.mock_port, args.mock_base_url, args.media_bytes, args.mock_latency / 1000)
+    workload = WorkloadGenerator(
+        mock_site.base_url,
+        args.download_path or f"/tmp/mcp-load-test/{uuid.uuid4().hex[:8]}",
+        args.repeat_ratio,
+        args.batch_size,
+        args.mode,
+    )
+    server_pattern = re.compile(args.server_pattern)
+    chrome_pattern = re.compile(args.chrome_pattern)
+    stats = Stats()
+
+    print(f"模拟站点: {mock_site.base_url}, MCP 服务: {args.url} ({args.transport}), "
+          f"{args.clients} 个会话, 运行 {args.duration} 秒", file=sys.stderr)
+
+    started_at = time.time()
+    started = time.monotonic()
+    deadline = started + args.duration
+    memory_samples = {"server": [], "chrome": []}
+    snapshots = []
+
+    def sample_memory(elapsed: float) -> Dict[str, Any]:
+        sample = {"server": process_memory(server_pattern), "chrome": process_memory(chrome_pattern)}
+        for name, value in sample.items():
+            memory_samples[name].append((elapsed, value))
+        return sample
+
+    sample_memory(0.0)
+    sessions = [
+        asyncio.create_task(run_session(index, args, weights, workload, stats, deadline))
+        for index in range(args.clients)
+    ]
+
+    window_started = started
+    while time.monotonic() < deadline:
+        await asyncio.sleep(min(args.snapshot_interval, max(deadline - time.monotonic(), 0)))
+        now = time.monotonic()
+        latencies, errors = stats.take_window()
+        memory = sample_memory(now - started)
+        window = summarize_latencies(latencies, errors)
+        snapshot = {
+            "elapsed_s": round(now - started, 1),
+            "throughput_per_s": round(len(latencies) / max(now - window_started, 1e-9), 3),
+            **window,
+            "server": memory["server"],
+            "chrome": memory["chrome"],
+        }
+        snapshots.append(snapshot)
+        window_started = now
+        print(json.dumps(snapshot, ensure_ascii=False), file=sys.stderr)
+
+    # 截止时间后不再发起新调用, 等待进行中的调用结束
+    done, pending = await asyncio.wait(sessions, timeout=args.call_timeout)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    mock_site.shutdown()
+
+    elapsed = time.monotonic() - started
+    all_latencies = [latency for values in stats.latencies.values() for latency in values]
+    total_errors = sum(stats.errors.values())
+    return {
+        "schema_version": REPORT_SCHEMA_VERSION,
+        "label": args.label,
+        "started_at": started_at,
+        "finished_at": time.time(),
+        "duration_s": round(elapsed, 1),
+        "config": {
+            "url": args.url,
+            "transport": args.transport,
+            "clients": args.clients,
+            "mix": weights,
+            "repeat_ratio": args.repeat_ratio,
+            "batch_size": args.batch_size,
+            "think_time": args.think_time,
+            "mode": args.mode,
+            "media_bytes": args.media_bytes,
+            "mock_latency_ms": args.mock_latency,
+            "call_timeout": args.call_timeout,
+        },
+        "totals": {
+            "throughput_per_s": round(len(all_latencies) / elapsed, 3) if elapsed else 0.0,
+            "sessions_opened": stats.sessions_opened,
+            "sessions_dropped": stats.sessions_dropped,
+            "mock_site_requests": mock_site.requests,
+            **summarize_latencies(all_latencies, total_errors),
+        },
+        "tools": {tool: summarize_latencies(values, stats.errors[tool]) for tool, values in sorted(stats.latencies.items())},
+        "errors": dict(stats.error_kinds.most_common()),
+        "memory": {name: memory_summary(samples) for name, samples in memory_samples.items()},
+        "snapshots": snapshots,
+    }
+
+
+# 对比时检查的指标: (路径, 数值越大越差)
+COMPARED_METRICS = [
+    (("totals", "throughput_per_s"), False),
+    (("totals", "error_rate"), True),
+    (("totals", "p50_ms"), True),
+    (("totals", "p99_ms"), True),
+    (("memory", "server", "slope_mb_per_hour"), True),
+    (("memory", "chrome", "slope_mb_per_hour"), True),
+    (("memory", "chrome", "processes_end"), True),
+]
+
+
+def lookup(report: Dict[str, Any], path: Tuple[str, ...]) -> Optional[float]:
+    value: Any = report
+    for key in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value if isinstance(value, (int, float)) else None
+
+
+def compare_reports(baseline: Dict[str, Any], current: Dict[str, Any], max_regression: float) -> Dict[str, Any]:
+    """
+    对比两份报告。相对变化超过 max_regression 且方向变差的指标记为退化;
+    基线为 0 的指标 (例如错误率) 只要变差即记为退化。
+    """
+    paths = list(COMPARED_METRICS)
+    for tool in sorted(set(baseline.get("tools", {})) & set(current.get("tools", {}))):
+        paths += [(("tools", tool, "p99_ms"), True), (("tools", tool, "error_rate"), True)]
+
+    metrics, regressions = {}, []
+    for path, higher_is_worse in paths:
+        before, after = lookup(baseline, path), lookup(current, path)
+        if before is None or after is None:
+            continue
+        change = (after - before) / abs(before) if before else (0.0 if after == before else math.inf)
+        worse = change > max_regression if higher_is_worse else change < -max_regression
+        name = ".".join(path)
+        metrics[name] = {
+            "baseline": before,
+            "current": after,
+            "change": None if math.isinf(change) else round(change, 4),
+            "regression": worse,
+        }
+        if worse:
+            regressions.append(name)
+
+    return {
+        "baseline_label": baseline.get("label"),
+        "current_label": current.get("label"),
+        "max_regression": max_regression,
+        "metrics": metrics,
+        "regressions": regressions,
+    }
+
+
+def write_json(data: Dict[str, Any], path: Optional[str]) -> None:
+    text = json.dumps(data, ensure_ascii=False, indent=2)
+    if path:
+        with open(path, "w") as f:
+            f.write(text + "\n")
+        print(f"报告已保存到 {path}", file=sys.stderr)
+    else:
+        print(text)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="MCP 服务的负载测试与稳定性测试")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run = subparsers.add_parser("run", help="运行负载测试并输出报告")
+    run.add_argument("--url", default="http://127.0.0.1:8000/sse", help="MCP 服务地址")
+    run.add_argument("--transport", choices=["sse", "http"], default="sse", help="MCP 传输方式")
+    run.add_argument("--clients", type=int, default=10, help="并发会话数")
+    run.add_argument("--duration", type=float, default=600, help="运行时长 (秒)")
+    run.add_argument("--ramp-up", type=float, default=30, help="所有会话建立完成所用的时间 (秒)")
+    run.add_argument("--mix", default=DEFAULT_MIX, help="工具调用权重, 格式为 tool=weight,...")
+    run.add_argument("--repeat-ratio", type=float, default=0.2, help="复用已请求过的视频的比例, 用于覆盖结果缓存")
+    run.add_argument("--batch-size", type=int, default=5, help="download_tiktok_videos 每次请求的视频数")
+    run.add_argument("--think-time", type=float, default=0, help="每个会话两次调用之间的平均间隔 (秒)")
+    run.add_argument("--call-timeout", type=float, default=300, help="单次调用的超时时间 (秒)")
+    run.add_argument("--mode", choices=["auto", "headless", "headed"], help="传给工具的执行模式, 默认使用服务端配置")
+    run.add_argument("--download-path", help="服务端保存下载文件的目录")
+    run.add_argument("--snapshot-interval", type=float, default=60, help="输出阶段快照的间隔 (秒)")
+    run.add_argument("--mock-host", default="127.0.0.1", help="模拟站点监听地址")
+    run.add_argument("--mock-port", type=int, default=0, help="模拟站点端口, 0 表示随机端口")
+    run.add_argument("--mock-base-url", help="服务访问模拟站点时使用的地址")
+    run.add_argument("--mock-latency", type=float, default=0, help="模拟站点每个请求的额外延迟 (毫秒)")
+    run.add_argument("--media-bytes", type=int, default=1024 * 1024, help="模拟视频文件的大小 (字节)")
+    run.add_argument("--server-pattern", default=r"mcp-server\.py", help="匹配服务进程命令行的正则")
+    run.add_argument("--chrome-pattern", default=r"(^|/)(google-chrome|chrome|chromium)[^ ]*( |$)", help="匹配 Chrome 进程命令行的正则")
+    run.add_argument("--label", help="报告标签, 例如版本号")
+    run.add_argument("--output", help="报告保存路径, 默认输出到标准输出")
+    run.add_argument("--baseline", help="基线报告, 指定时在报告中附带对比结果")
+    run.add_argument("--max-regression", type=float, default=0.2, help="允许的最大相对退化")
+
+    compare = subparsers.add_parser("compare", help="对比两份报告")
+    compare.add_argument("baseline", help="基线报告")
+    compare.add_argument("current", help="当前报告")
+    compare.add_argument("--max-regression", type=float, default=0.2, help="允许的最大相对退化")
+    compare.add_argument("--output", help="对比结果保存路径, 默认输出到标准输出")
+    return parser
+
+
+def main() -> int:
+    args = build_parser().parse_args()
+
+    if args.command == "compare":
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        comparison = compare_reports(baseline, current, args.max_regression)
+        write_json(comparison, args.output)
+        return 1 if comparison["regressions"] else 0
+
+    report = asyncio.run(run_load_test(args))
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["comparison"] = compare_reports(json.load(f), report, args.max_regression)
+    write_json(report, args.output)
+    return 1 if report.get("comparison", {}).get("regressions") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,15 @@
+import importlib.util
+import pathlib
+
+import pytest
+
+SERVER_PATH = pathlib.Path(__file__).resolve().parent.parent / "mcp-server.py"
+
+
+@pytest.fixture(scope="session")
+def server():
+    """以模块方式加载 mcp-server.py (文件名带连字符, 不能直接 import)。"""
+    spec = importlib.util.spec_from_file_location("mcp_server", SERVER_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,139 @@
+import asyncio
+import multiprocessing
+import os
+import subprocess
+import sys
+from contextlib import asynccontextmanager
+
+import pytest
+
+
+@pytest.fixture
+def pool(server):
+    return server.BrowserPool(headless_size=0, base_port=9300)
+
+
+def test_headed_browser_is_leased_exclusively(pool):
+    lease = pool.acquire("headed", timeout=1)
+    with pytest.raises(TimeoutError):
+        pool.acquire("headed", timeout=0.1)
+
+    pool.release(lease["id"])
+    assert pool.acquire("headed", timeout=0.1)["cdp_url"] == lease["cdp_url"]
+
+
+def test_lease_of_dead_owner_is_reclaimed(pool):
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+
+    pool.acquire("headed", timeout=1, owner=process.pid)
+    assert pool.acquire("headed", timeout=0.1, owner=os.getpid())
+
+
+def test_lease_of_live_owner_is_kept(pool):
+    pool.acquire("headed", timeout=1, owner=os.getpid())
+    with pytest.raises(TimeoutError):
+        pool.acquire("headed", timeout=0.1)
+
+
+@pytest.fixture
+def remote_pool(server, monkeypatch):
+    """在 fork 出的管理进程中运行浏览器池, 与多进程模式相同。"""
+    monkeypatch.setattr(server, "BROWSER_POOL_AUTHKEY", os.urandom(32))
+    monkeypatch.setattr(server, "BROWSER_LEASE_TIMEOUT", 5)
+    manager = server.BrowserPoolManager(
+        address=("127.0.0.1", 0),
+        authkey=server.BROWSER_POOL_AUTHKEY,
+        ctx=multiprocessing.get_context("fork"),
+    )
+    manager.start()
+    host, port = manager.address
+    yield server.BrowserLeaseClient(f"{host}:{port}")
+    manager.shutdown()
+
+
+def test_cancelled_waiter_does_not_keep_lease(remote_pool):
+    async def scenario():
+        holder_ready, holder_release = asyncio.Event(), asyncio.Event()
+
+        async def holder():
+            async with remote_pool.lease("headed"):
+                holder_ready.set()
+                await holder_release.wait()
+
+        async def waiter():
+            async with remote_pool.lease("headed"):
+                pass
+
+        holding = asyncio.create_task(holder())
+        await holder_ready.wait()
+
+        # 等待中的调用被取消; 之后它在线程中租到的浏览器必须被归还
+        waiting = asyncio.create_task(waiter())
+        await asyncio.sleep(0.2)
+        waiting.cancel()
+        holder_release.set()
+        await holding
+
+        await asyncio.sleep(0.5)
+        async with remote_pool.lease("headed") as cdp_url:
+            return cdp_url, waiting.cancelled()
+
+    cdp_url, cancelled = asyncio.run(asyncio.wait_for(scenario(), timeout=4))
+    assert cdp_url
+    assert cancelled
+
+
+def test_run_task_holds_headed_lease_for_whole_agent_run(server, monkeypatch, tmp_path):
+    events = []
+
+    class FakePool:
+        @asynccontextmanager
+        async def lease(self, kind):
+            events.append(("lease", kind))
+            yield "http://leased:9222"
+            events.append(("release", kind))
+
+    class FakeSession:
+        def __init__(self, cdp_url, id):
+            events.append(("session", cdp_url))
+
+    class FakeHistory:
+        def final_result(self):
+            return "done"
+
+        def model_dump(self):
+            return {"history": []}
+
+    class FakeAgent:
+        def __init__(self, **kwargs):
+            pass
+
+        async def run(self, max_steps):
+            events.append(("agent_run", max_steps))
+            return FakeHistory()
+
+    monkeypatch.setattr(server, "browser_pool", FakePool())
+    monkeypatch.setattr(server, "CompressingBrowserSession", FakeSession)
+    monkeypatch.setattr(server, "Agent", FakeAgent)
+    monkeypatch.setattr(server, "create_llm_client", lambda **kwargs: object())
+    monkeypatch.setattr(server, "archive_history", lambda history_data, history_dir: history_dir)
+    monkeypatch.setattr(server, "HISTORY_DIR", str(tmp_path))
+
+    result = asyncio.run(server.run_task(
+        task_id="task",
+        task="do something",
+        session_id="session",
+        model_provider=server.LLMProvider.OPENAI,
+        model_name="gpt-4.1-mini",
+        model_kwargs=None,
+        max_steps=3,
+    ))
+
+    assert result.status == 1
+    assert events == [
+        ("lease", "headed"),
+        ("session", "http://leased:9222"),
+        ("agent_run", 3),
+        ("release", "headed"),
+    ]
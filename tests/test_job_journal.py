@@ -0,0 +1,310 @@
+import asyncio
+import threading
+import time
+import types
+
+import pytest
+
+
+@pytest.fixture
+def journal(server, tmp_path):
+    return server.JobJournal(str(tmp_path / "jobs.sqlite3"))
+
+
+def test_job_state_transitions(server, journal):
+    job_id, existing = journal.start("text_to_video", "key", "一只猫在海边奔跑", "视频")
+    assert existing is None
+    assert journal.get(job_id)["status"] == server.JobStatus.STARTED.value
+    assert [job["id"] for job in journal.unfinished()] == [job_id]
+
+    journal.update(job_id, server.JobStatus.SUBMITTED, result={"is_visible": False})
+    journal.update(job_id, server.JobStatus.QUEUED, error="ignored later")
+    job = journal.get(job_id)
+    assert job["status"] == server.JobStatus.QUEUED.value
+    # result 为空时保留原值
+    assert job["result"] == {"is_visible": False}
+    assert journal.unfinished() == []
+
+
+def test_dedup_returns_existing_job_within_window(server, journal):
+    job_id, _ = journal.start("text_to_video", "key", "prompt", "视频")
+    journal.update(job_id, server.JobStatus.SUBMITTED)
+
+    again_id, existing = journal.start("text_to_video", "key", "prompt", "视频", dedup_since=time.time() - 60)
+    assert again_id == job_id
+    assert existing["status"] == server.JobStatus.SUBMITTED.value
+
+
+def test_dedup_ignores_old_and_failed_jobs(server, journal):
+    old_id, _ = journal.start("text_to_video", "key", "prompt", "视频")
+    journal.update(old_id, server.JobStatus.SUBMITTED)
+    failed_id, _ = journal.start("text_to_video", "key", "prompt", "视频")
+    journal.update(failed_id, server.JobStatus.FAILED)
+
+    new_id, existing = journal.start("text_to_video", "key", "prompt", "视频", dedup_since=time.time() + 1)
+    assert existing is None
+    assert new_id not in (old_id, failed_id)
+
+    journal.update(new_id, server.JobStatus.INTERRUPTED)
+    _, existing = journal.start("text_to_video", "key", "prompt", "视频", dedup_since=time.time() - 60)
+    assert existing["id"] == old_id
+
+
+def test_dedup_ignores_confirmed_jobs_by_default(server, journal):
+    job_id, _ = journal.start("text_to_video", "key", "prompt", "视频")
+    journal.update(job_id, server.JobStatus.QUEUED)
+
+    new_id, existing = journal.start("text_to_video", "key", "prompt", "视频", dedup_since=time.time() - 60)
+    assert existing is None
+    assert new_id != job_id
+
+    journal.update(new_id, server.JobStatus.DOWNLOADED)
+    _, existing = journal.start(
+        "text_to_video",
+        "key",
+        "prompt",
+        "视频",
+        dedup_since=time.time() - 60,
+        dedup_statuses=tuple(server.JobStatus),
+    )
+    assert existing["id"] == new_id
+
+
+def test_without_dedup_always_starts_new_job(journal):
+    first_id, _ = journal.start("text_to_video", "key", "prompt", "视频")
+    second_id, existing = journal.start("text_to_video", "key", "prompt", "视频")
+    assert existing is None
+    assert first_id != second_id
+
+
+def test_concurrent_start_is_atomic(server, tmp_path):
+    db_path = str(tmp_path / "jobs.sqlite3")
+    # 每个线程使用独立的连接, 模拟多个工作进程
+    journals = [server.JobJournal(db_path) for _ in range(8)]
+    journals[0].conn
+    barrier = threading.Barrier(len(journals))
+    results = []
+
+    def start(journal):
+        barrier.wait()
+        results.append(journal.start("text_to_video", "key", "prompt", "视频", dedup_since=time.time() - 60))
+
+    threads = [threading.Thread(target=start, args=(journal,)) for journal in journals]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sum(existing is None for _, existing in results) == 1
+    assert len({job_id for job_id, _ in results}) == 1
+
+
+def test_find_by_prompt_matches_fragment_and_type(server, journal):
+    video_id, _ = journal.start("text_to_video", "a", "一只猫在海边奔跑", "视频")
+    journal.update(video_id, server.JobStatus.QUEUED)
+    image_id, _ = journal.start("text_to_image", "b", "一只猫在海边奔跑", "图片")
+    journal.update(image_id, server.JobStatus.QUEUED)
+
+    assert journal.find_by_prompt("海边", "视频")["id"] == video_id
+    assert journal.find_by_prompt("海边", "图片")["id"] == image_id
+    assert journal.find_by_prompt("森林") is None
+
+
+def test_find_by_prompt_exact(server, journal):
+    short_id, _ = journal.start("text_to_video", "a", "一只猫", "视频")
+    journal.update(short_id, server.JobStatus.QUEUED)
+    long_id, _ = journal.start("text_to_video", "b", "一只猫在海边奔跑", "视频")
+    journal.update(long_id, server.JobStatus.QUEUED)
+
+    assert journal.find_by_prompt("一只猫", "视频")["id"] == long_id
+    assert journal.find_by_prompt("一只猫", "视频", exact=True)["id"] == short_id
+    assert journal.find_by_prompt("海边", "视频", exact=True) is None
+
+
+def test_record_download_ignores_longer_prompts(server, journal, monkeypatch):
+    monkeypatch.setattr(server, "job_journal", journal)
+    long_id, _ = journal.start("text_to_video", "a", "一只猫在海边奔跑", "视频")
+    journal.update(long_id, server.JobStatus.QUEUED)
+
+    # 按片段下载的作品不能记录到提示词更长的其他任务上
+    assert server.record_download("一只猫", "视频", "/tmp/cat.mp4") is None
+    assert journal.get(long_id)["status"] == server.JobStatus.QUEUED.value
+
+    assert server.record_download("一只猫", "视频", "/tmp/cat.mp4", job_id=long_id) == long_id
+    assert journal.get(long_id)["result"]["filePath"] == "/tmp/cat.mp4"
+
+
+def test_find_downloaded_result_links_exact_match(server, journal, monkeypatch, tmp_path):
+    monkeypatch.setattr(server, "job_journal", journal)
+    source = tmp_path / "prefetch" / "cat.mp4"
+    source.parent.mkdir()
+    source.write_bytes(b"video")
+    job_id, _ = journal.start("text_to_video", "a", "一只猫在海边奔跑", "视频")
+    journal.update(job_id, server.JobStatus.DOWNLOADED, result={"filePath": str(source)})
+
+    target_dir = tmp_path / "download"
+    assert asyncio.run(server.find_downloaded_result("一只猫", "视频", str(target_dir))) is None
+
+    result = asyncio.run(server.find_downloaded_result("一只猫在海边奔跑", "视频", str(target_dir)))
+    assert result == {"filePath": "cat.mp4"}
+    assert (target_dir / "cat.mp4").read_bytes() == b"video"
+
+
+@pytest.fixture
+def isolated_jobs(server, journal, monkeypatch):
+    """run_job 使用临时任务日志, 浏览器流程替换为计数的假流程。"""
+    state = types.SimpleNamespace(calls=[], is_visible=True)
+
+    async def fake_run_flow(tool_name, flow, mode=None, close_context=False):
+        state.calls.append(tool_name)
+        await asyncio.sleep(0.01)
+        # is_visible 为 False 时, 任务在站点上未确认, 保持 submitted 状态
+        return {"is_visible": state.is_visible}
+
+    monkeypatch.setattr(server, "job_journal", journal)
+    monkeypatch.setattr(server, "run_flow", fake_run_flow)
+    monkeypatch.setattr(server, "PREFETCH_ENABLED", False)
+    return state
+
+
+def test_run_job_coalesces_concurrent_calls(server, isolated_jobs):
+    async def scenario():
+        return await asyncio.gather(*(
+            server.run_job("text_to_video", {"text": "prompt"}, None, prompt="prompt", work_type="视频")
+            for _ in range(3)
+        ))
+
+    results = asyncio.run(scenario())
+    assert isolated_jobs.calls == ["text_to_video"]
+    assert len({result["job_id"] for result in results}) == 1
+    assert all(result["job_status"] == "queued" for result in results)
+
+
+def test_run_job_dedups_unconfirmed_and_force_resubmits(server, isolated_jobs):
+    isolated_jobs.is_visible = False
+
+    async def scenario():
+        first = await server.run_job("text_to_video", {"text": "prompt"}, None, prompt="prompt", work_type="视频")
+        again = await server.run_job("text_to_video", {"text": "prompt"}, None, prompt="prompt", work_type="视频")
+        forced = await server.run_job("text_to_video", {"text": "prompt"}, None, prompt="prompt", work_type="视频", force=True)
+        return first, again, forced
+
+    first, again, forced = asyncio.run(scenario())
+    assert again["job_id"] == first["job_id"]
+    assert forced["job_id"] != first["job_id"]
+    assert again["job_status"] == "submitted"
+    assert isolated_jobs.calls == ["text_to_video", "text_to_video"]
+
+
+def test_run_job_regenerates_confirmed_jobs_by_default(server, isolated_jobs, monkeypatch):
+    async def scenario():
+        first = await server.run_job("text_to_video", {"text": "prompt"}, None, prompt="prompt", work_type="视频")
+        again = await server.run_job("text_to_video", {"text": "prompt"}, None, prompt="prompt", work_type="视频")
+        return first, again
+
+    first, again = asyncio.run(scenario())
+    assert first["job_status"] == "queued"
+    assert again["job_id"] != first["job_id"]
+
+    monkeypatch.setattr(server, "JOB_DEDUP_COMPLETED", True)
+    third = asyncio.run(server.run_job("text_to_video", {"text": "prompt"}, None, prompt="prompt", work_type="视频"))
+    assert third["job_id"] == again["job_id"]
+    assert isolated_jobs.calls == ["text_to_video", "text_to_video"]
+
+
+def test_run_job_marks_failure_before_submit(server, journal, monkeypatch):
+    async def failing_run_flow(tool_name, flow, mode=None, close_context=False):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(server, "job_journal", journal)
+    monkeypatch.setattr(server, "run_flow", failing_run_flow)
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(server.run_job("text_to_video", {"text": "prompt"}, None, prompt="prompt", work_type="视频"))
+    assert journal.unfinished() == []
+
+
+def test_background_tasks_survive_lifespan_exit(server, monkeypatch):
+    runs = []
+
+    async def forever(name):
+        runs.append(name)
+        await asyncio.Event().wait()
+
+    monkeypatch.setattr(server, "reconcile_jobs", lambda: forever("reconcile_jobs"))
+    monkeypatch.setattr(server, "run_prefetcher", lambda: forever("prefetcher"))
+    monkeypatch.setattr(server, "_background_tasks", {})
+
+    async def scenario():
+        # 模拟按会话进入 lifespan: 第一个会话退出后, 后台任务仍在运行且不会被重复启动
+        for _ in range(2):
+            async with server.server_lifespan(server.mcp):
+                await asyncio.sleep(0)
+        tasks = dict(server._background_tasks)
+        alive = [name for name, task in tasks.items() if not task.done()]
+        for task in tasks.values():
+            task.cancel()
+        return alive
+
+    assert sorted(asyncio.run(scenario())) == ["prefetcher", "reconcile_jobs"]
+    assert sorted(runs) == ["prefetcher", "reconcile_jobs"]
+
+
+def test_claim_prefetch_hands_out_each_job_once(server, tmp_path):
+    db_path = str(tmp_path / "jobs.sqlite3")
+    journal = server.JobJournal(db_path)
+    job_id, _ = journal.start("text_to_video", "key", "prompt", "视频")
+    journal.enqueue_prefetch(job_id, str(tmp_path), delay=0)
+    # 重复加入队列时保留原有记录
+    journal.enqueue_prefetch(job_id, str(tmp_path), delay=3600)
+
+    # 多个工作进程同时领取时只有一个能领到
+    journals = [server.JobJournal(db_path) for _ in range(4)]
+    claims = [journal.claim_prefetch(lease_seconds=60) for journal in journals]
+    assert sum(len(claim) for claim in claims) == 1
+    claimed = next(claim for claim in claims if claim)[0]
+    assert claimed["job_id"] == job_id
+    assert claimed["prompt"] == "prompt"
+    assert claimed["work_type"] == "视频"
+
+
+def test_prefetch_retry_and_finish(journal, tmp_path):
+    job_id, _ = journal.start("text_to_video", "key", "prompt", "视频")
+    journal.enqueue_prefetch(job_id, str(tmp_path), delay=0)
+    assert journal.claim_prefetch(lease_seconds=60)
+
+    assert journal.retry_prefetch(job_id, delay=0) == 1
+    assert journal.claim_prefetch(lease_seconds=60)[0]["attempts"] == 1
+
+    journal.retry_prefetch(job_id, delay=3600)
+    assert journal.claim_prefetch(lease_seconds=60) == []
+
+    journal.finish_prefetch(job_id)
+    assert journal.retry_prefetch(job_id, delay=0) == 0
+
+
+def test_prefetcher_runs_headless_only(server, journal, tmp_path, monkeypatch):
+    modes = []
+
+    async def fake_run_flow(tool_name, flow, mode=None, close_context=False):
+        modes.append(mode)
+        raise server.HumanRequiredError("login")
+
+    monkeypatch.setattr(server, "job_journal", journal)
+    monkeypatch.setattr(server, "run_flow", fake_run_flow)
+    monkeypatch.setattr(server, "PREFETCH_INTERVAL", 0.01)
+
+    job_id, _ = journal.start("text_to_video", "key", "prompt", "视频")
+    journal.update(job_id, server.JobStatus.QUEUED)
+    journal.enqueue_prefetch(job_id, str(tmp_path), delay=0)
+
+    async def scenario():
+        task = asyncio.create_task(server.run_prefetcher())
+        while not modes:
+            await asyncio.sleep(0.01)
+        task.cancel()
+
+    asyncio.run(asyncio.wait_for(scenario(), timeout=5))
+    assert set(modes) == {server.ExecutionMode.HEADLESS}
+    # 失败后记录尝试次数并重新排队
+    assert [job["attempts"] for job in journal.claim_prefetch(lease_seconds=60)] == [len(modes)]
@@ -0,0 +1,16 @@
+import logging
+
+
+def test_invalid_log_level_falls_back_to_info(server, monkeypatch):
+    monkeypatch.setattr(server, "LOG_LEVEL", "BOGUS")
+    assert server.setup_logging().level == logging.INFO
+
+
+def test_log_context_is_captured_on_record(server):
+    record = logging.LogRecord("mcp_browser", logging.INFO, __file__, 1, "event", None, None)
+    token = server.log_context.set({"call_id": "abc"})
+    try:
+        assert server.LogContextFilter().filter(record)
+    finally:
+        server.log_context.reset(token)
+    assert '"call_id": "abc"' in server.JsonFormatter().format(record)
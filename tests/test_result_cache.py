@@ -0,0 +1,148 @@
+import asyncio
+import os
+
+import pytest
+
+
+@pytest.fixture
+def downloaded(tmp_path):
+    path = tmp_path / "video.mp4"
+    path.write_bytes(b"video")
+    return str(path)
+
+
+def test_put_and_get_returns_copy(server, downloaded):
+    cache = server.ResultCache(max_size=10, ttl=60)
+    cache.put("key", {"filePath": downloaded}, downloaded)
+
+    result = cache.get("key")
+    assert result == {"filePath": downloaded}
+    result["filePath"] = "changed"
+    assert cache.get("key") == {"filePath": downloaded}
+
+
+def test_put_skips_missing_file(server, tmp_path):
+    cache = server.ResultCache(max_size=10, ttl=60)
+    cache.put("key", {"filePath": "missing.mp4"}, str(tmp_path / "missing.mp4"))
+    assert cache.get("key") is None
+
+
+def test_expired_entry_is_dropped(server, downloaded):
+    cache = server.ResultCache(max_size=10, ttl=-1)
+    cache.put("key", {"filePath": downloaded}, downloaded)
+    assert cache.get("key") is None
+
+
+def test_lru_eviction_keeps_recently_used(server, tmp_path):
+    cache = server.ResultCache(max_size=2, ttl=60)
+    paths = {}
+    for name in ("a", "b", "c"):
+        path = tmp_path / f"{name}.mp4"
+        path.write_bytes(name.encode())
+        paths[name] = str(path)
+
+    cache.put("a", {"filePath": paths["a"]}, paths["a"])
+    cache.put("b", {"filePath": paths["b"]}, paths["b"])
+    assert cache.get("a") is not None
+    cache.put("c", {"filePath": paths["c"]}, paths["c"])
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+
+
+def test_entry_invalidated_when_file_changes(server, downloaded):
+    cache = server.ResultCache(max_size=10, ttl=60)
+    cache.put("key", {"filePath": downloaded}, downloaded)
+
+    mtime = os.path.getmtime(downloaded)
+    os.utime(downloaded, (mtime + 10, mtime + 10))
+    assert cache.get("key") is None
+
+
+def test_entry_invalidated_when_file_deleted(server, downloaded):
+    cache = server.ResultCache(max_size=10, ttl=60)
+    cache.put("key", {"filePath": downloaded}, downloaded)
+
+    os.remove(downloaded)
+    assert cache.get("key") is None
+
+
+def test_concurrent_calls_are_coalesced_and_cached(server, downloaded):
+    cache = server.ResultCache(max_size=10, ttl=60)
+    calls = 0
+
+    async def factory():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return {"filePath": downloaded}
+
+    async def scenario():
+        results = await asyncio.gather(*(cache.run("key", factory, lambda r: r["filePath"]) for _ in range(5)))
+        cached = await cache.run("key", factory, lambda r: r["filePath"])
+        return results, cached
+
+    results, cached = asyncio.run(scenario())
+    assert calls == 1
+    assert all(result == {"filePath": downloaded} for result in results)
+    assert cached == {"filePath": downloaded}
+
+
+def test_failures_are_not_cached(server, downloaded):
+    cache = server.ResultCache(max_size=10, ttl=60)
+    calls = 0
+
+    async def factory():
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            raise RuntimeError("boom")
+        return {"filePath": downloaded}
+
+    async def scenario():
+        with pytest.raises(RuntimeError):
+            await cache.run("key", factory, lambda r: r["filePath"])
+        return await cache.run("key", factory, lambda r: r["filePath"])
+
+    assert asyncio.run(scenario()) == {"filePath": downloaded}
+    assert calls == 2
+
+
+def test_cancelled_caller_does_not_cancel_shared_run(server, downloaded):
+    cache = server.ResultCache(max_size=10, ttl=60)
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def factory():
+            await release.wait()
+            return {"filePath": downloaded}
+
+        first = asyncio.create_task(cache.run("key", factory, lambda r: r["filePath"]))
+        second = asyncio.create_task(cache.run("key", factory, lambda r: r["filePath"]))
+        await asyncio.sleep(0)
+        first.cancel()
+        release.set()
+        return await second, first
+
+    result, first = asyncio.run(scenario())
+    assert result == {"filePath": downloaded}
+    assert first.cancelled()
+
+
+@pytest.mark.parametrize(
+    ("url", "drop_query", "expected"),
+    [
+        (" HTTPS://Example.COM/path/?a=1#frag ", False, "https://example.com/path?a=1"),
+        ("https://www.tiktok.com/@user/video/123?is_from_webapp=1", True, "https://www.tiktok.com/@user/video/123"),
+        ("https://example.com/", False, "https://example.com"),
+    ],
+)
+def test_normalize_url(server, url, drop_query, expected):
+    assert server.normalize_url(url, drop_query=drop_query) == expected
+
+
+def test_cache_key_distinguishes_arguments(server):
+    assert server.cache_key("tool", "a", None) != server.cache_key("tool", "a", "b")
+    assert server.cache_key("tool", "a") == server.cache_key("tool", "a")
@@ -0,0 +1,114 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+from playwright.async_api import Error as PlaywrightError
+
+
+class FakeLocator:
+    def __init__(self, count):
+        self._count = count
+
+    async def count(self):
+        return self._count
+
+
+class FakePage:
+    def __init__(self, kind, url="https://hailuoai.com/create", captcha=False):
+        self.kind = kind
+        self.url = url
+        self.captcha = captcha
+
+    def locator(self, selector):
+        return FakeLocator(1 if self.captcha else 0)
+
+
+@pytest.fixture
+def browsers(server, monkeypatch):
+    """用假的页面替换无头/有头浏览器, 记录每次流程运行在哪条路径上。"""
+    state = {"headless_page": FakePage("headless"), "runs": []}
+
+    @asynccontextmanager
+    async def fake_headless_page(tool_name):
+        yield state["headless_page"]
+
+    @asynccontextmanager
+    async def fake_cdp_page(tool_name, close_context=False):
+        yield FakePage("headed")
+
+    monkeypatch.setattr(server, "headless_page", fake_headless_page)
+    monkeypatch.setattr(server, "cdp_page", fake_cdp_page)
+    return state
+
+
+def run(server, flow, mode):
+    return asyncio.run(server.run_flow("tool", flow, mode))
+
+
+def test_human_required_before_submit_falls_back(server, browsers):
+    async def flow(page):
+        browsers["runs"].append(page.kind)
+        if page.kind == "headless":
+            raise server.HumanRequiredError("login")
+        return {"kind": page.kind}
+
+    assert run(server, flow, server.ExecutionMode.AUTO) == {"kind": "headed"}
+    assert browsers["runs"] == ["headless", "headed"]
+
+
+def test_human_required_after_submit_is_raised(server, browsers):
+    async def flow(page):
+        browsers["runs"].append(page.kind)
+        server.mark_submitted()
+        raise server.HumanRequiredError("login")
+
+    with pytest.raises(server.HumanRequiredError):
+        run(server, flow, server.ExecutionMode.AUTO)
+    assert browsers["runs"] == ["headless"]
+
+
+@pytest.mark.parametrize("error", [PlaywrightError("Timeout 30000ms exceeded"), AssertionError("not visible")])
+def test_plain_failure_without_block_signal_does_not_fall_back(server, browsers, error):
+    async def flow(page):
+        browsers["runs"].append(page.kind)
+        raise error
+
+    with pytest.raises(type(error)):
+        run(server, flow, server.ExecutionMode.AUTO)
+    assert browsers["runs"] == ["headless"]
+
+
+@pytest.mark.parametrize(
+    "page",
+    [FakePage("headless", url="https://hailuoai.com/login"), FakePage("headless", captcha=True)],
+)
+def test_timeout_on_blocked_page_falls_back(server, browsers, page):
+    browsers["headless_page"] = page
+
+    async def flow(page):
+        browsers["runs"].append(page.kind)
+        if page.kind == "headless":
+            raise PlaywrightError("Timeout 30000ms exceeded")
+        return {"kind": page.kind}
+
+    assert run(server, flow, server.ExecutionMode.AUTO) == {"kind": "headed"}
+    assert browsers["runs"] == ["headless", "headed"]
+
+
+def test_headless_mode_never_falls_back(server, browsers):
+    async def flow(page):
+        browsers["runs"].append(page.kind)
+        raise server.HumanRequiredError("login")
+
+    with pytest.raises(server.HumanRequiredError):
+        run(server, flow, server.ExecutionMode.HEADLESS)
+    assert browsers["runs"] == ["headless"]
+
+
+def test_headed_mode_skips_headless(server, browsers):
+    async def flow(page):
+        browsers["runs"].append(page.kind)
+        return {}
+
+    run(server, flow, server.ExecutionMode.HEADED)
+    assert browsers["runs"] == ["headed"]
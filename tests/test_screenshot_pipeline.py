@@ -0,0 +1,130 @@
+import asyncio
+import base64
+import gzip
+import io
+import json
+from types import SimpleNamespace
+
+import pytest
+
+Image = pytest.importorskip("PIL.Image")
+ImageDraw = pytest.importorskip("PIL.ImageDraw")
+
+
+def screenshot(text=None):
+    image = Image.new("RGB", (1920, 1080), "white")
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((600, 500, 1320, 560), outline="black")
+    if text:
+        draw.text((610, 520), text, fill="black")
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+def test_small_change_is_sent_to_llm(server):
+    pipeline = server.ScreenshotPipeline(max_width=1280)
+    before = screenshot()
+    after = screenshot("search for cheap flights to tokyo")
+
+    # 感知哈希认为两帧相同, 但发送给 LLM 的必须是当前帧
+    hash_before = pipeline.prepare(before)[1]
+    hash_after = pipeline.prepare(after)[1]
+    assert pipeline.is_duplicate(hash_before, hash_after)
+
+    first = pipeline.compress_for_llm(before)
+    second = pipeline.compress_for_llm(after)
+    assert first != second
+
+
+def test_identical_screenshot_reuses_output(server):
+    pipeline = server.ScreenshotPipeline(max_width=1280)
+    frame = screenshot("hello")
+    assert pipeline.compress_for_llm(frame) is pipeline.compress_for_llm(frame)
+
+
+def test_compressed_screenshot_keeps_size_without_llm_size(server):
+    pipeline = server.ScreenshotPipeline(max_width=1280)
+    output = Image.open(io.BytesIO(base64.b64decode(pipeline.compress_for_llm(screenshot()))))
+    assert output.format == "PNG"
+    assert output.size == (1920, 1080)
+
+
+def test_compressed_screenshot_matches_llm_size(server):
+    pipeline = server.ScreenshotPipeline(max_width=1280)
+    size = pipeline.llm_size((1920, 1080))
+    assert size == (1280, 720)
+    output = Image.open(io.BytesIO(base64.b64decode(pipeline.compress_for_llm(screenshot(), (1920, 1080), size))))
+    assert output.size == size
+
+
+def test_session_sets_llm_screenshot_size(server):
+    session = server.CompressingBrowserSession(cdp_url="http://127.0.0.1:9222")
+    summary = SimpleNamespace(
+        screenshot=screenshot(),
+        page_info=SimpleNamespace(viewport_width=1920, viewport_height=1080),
+    )
+    summary = asyncio.run(session._compress_summary(summary))
+
+    # browser_use 按 llm_screenshot_size 把 LLM 的坐标换算回视口坐标
+    assert tuple(session.llm_screenshot_size) == (1280, 720)
+    assert Image.open(io.BytesIO(base64.b64decode(summary.screenshot))).size == (1280, 720)
+
+
+def test_session_keeps_agent_llm_screenshot_size(server):
+    session = server.CompressingBrowserSession(cdp_url="http://127.0.0.1:9222")
+    session.llm_screenshot_size = (1400, 850)
+    summary = SimpleNamespace(
+        screenshot=screenshot(),
+        page_info=SimpleNamespace(viewport_width=1920, viewport_height=1080),
+    )
+    summary = asyncio.run(session._compress_summary(summary))
+
+    assert tuple(session.llm_screenshot_size) == (1400, 850)
+    assert Image.open(io.BytesIO(base64.b64decode(summary.screenshot))).size == (1400, 850)
+
+
+def test_archive_history_reads_screenshot_paths(server, tmp_path):
+    from browser_use.agent.views import AgentHistory, AgentHistoryList
+    from browser_use.browser.views import BrowserStateHistory
+
+    screenshots_dir = tmp_path / "agent" / "screenshots"
+    screenshots_dir.mkdir(parents=True)
+    steps = []
+    other_page = io.BytesIO()
+    Image.new("RGB", (1920, 1080), "black").save(other_page, format="PNG")
+    frames = [base64.b64decode(screenshot()), base64.b64decode(screenshot()), other_page.getvalue()]
+    for index, frame in enumerate(frames):
+        path = screenshots_dir / f"step_{index}.png"
+        path.write_bytes(frame)
+        steps.append(AgentHistory(
+            model_output=None,
+            result=[],
+            state=BrowserStateHistory(
+                url="https://example.com",
+                title="Example",
+                tabs=[],
+                interacted_element=[],
+                screenshot_path=str(path),
+            ),
+        ))
+    steps.append(AgentHistory(
+        model_output=None,
+        result=[],
+        state=BrowserStateHistory(url="https://example.com", title="Example", tabs=[], interacted_element=[]),
+    ))
+
+    history_dir = tmp_path / "history"
+    history_dir.mkdir()
+    history_path = server.archive_history(AgentHistoryList(history=steps).model_dump(), str(history_dir))
+
+    with gzip.open(history_path, "rt", encoding="utf-8") as f:
+        history = json.load(f)
+    paths = [step["state"]["screenshot_path"] for step in history["history"]]
+
+    assert all(path.startswith("frames/") for path in paths[:3])
+    assert paths[0] == paths[1]
+    assert paths[3] is None
+    frames = list((history_dir / "frames").iterdir())
+    assert len(frames) == 2
+    assert Image.open(history_dir / paths[0]).width == 1280
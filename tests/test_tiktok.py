@@ -0,0 +1,62 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+
+def rehydration(video):
+    return json.dumps({
+        "__DEFAULT_SCOPE__": {
+            "webapp.video-detail": {"itemInfo": {"itemStruct": {"id": "1", "video": video}}}
+        }
+    })
+
+
+def test_parse_prefers_play_addr(server):
+    raw = rehydration({"playAddr": "https://v/play.mp4", "downloadAddr": "https://v/download.mp4"})
+    assert server.parse_tiktok_media_url(raw) == "https://v/play.mp4"
+
+
+def test_parse_falls_back_to_download_addr(server):
+    raw = rehydration({"playAddr": "", "downloadAddr": "https://v/download.mp4"})
+    assert server.parse_tiktok_media_url(raw) == "https://v/download.mp4"
+
+
+@pytest.mark.parametrize("raw", ["{}", json.dumps({"__DEFAULT_SCOPE__": {}}), rehydration({})])
+def test_parse_returns_none_without_video(server, raw):
+    assert server.parse_tiktok_media_url(raw) is None
+
+
+def test_stream_to_file_writes_complete_file(server, tmp_path):
+    transport = httpx.MockTransport(lambda request: httpx.Response(200, content=b"video-bytes"))
+    save_path = tmp_path / "1.mp4"
+
+    async def scenario():
+        async with httpx.AsyncClient(transport=transport) as client:
+            await server.stream_to_file(client, "https://v/1.mp4", str(save_path))
+
+    asyncio.run(scenario())
+    assert save_path.read_bytes() == b"video-bytes"
+    assert not (tmp_path / "1.mp4.part").exists()
+
+
+class BrokenStream(httpx.AsyncByteStream):
+    """先返回一部分数据, 然后连接中断。"""
+
+    async def __aiter__(self):
+        yield b"partial"
+        raise httpx.ReadError("connection reset")
+
+
+def test_stream_to_file_removes_partial_file_on_error(server, tmp_path):
+    transport = httpx.MockTransport(lambda request: httpx.Response(200, stream=BrokenStream()))
+    save_path = tmp_path / "1.mp4"
+
+    async def scenario():
+        async with httpx.AsyncClient(transport=transport) as client:
+            await server.stream_to_file(client, "https://v/1.mp4", str(save_path))
+
+    with pytest.raises(httpx.ReadError):
+        asyncio.run(scenario())
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,101 @@
+import asyncio
+import os
+
+import pytest
+
+
+def make_trace(directory, name, size, mtime):
+    path = directory / name
+    path.write_bytes(b"x" * size)
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_prune_keeps_newest_files_within_count(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "TRACE_MAX_FILES", 2)
+    monkeypatch.setattr(server, "TRACE_MAX_BYTES", 10 ** 9)
+    for index in range(4):
+        make_trace(tmp_path, f"{index}.zip", 10, 1000 + index)
+    (tmp_path / "notes.txt").write_text("not a trace")
+
+    server.prune_traces(str(tmp_path))
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["2.zip", "3.zip", "notes.txt"]
+
+
+def test_prune_keeps_total_size_within_limit(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "TRACE_MAX_FILES", 100)
+    monkeypatch.setattr(server, "TRACE_MAX_BYTES", 250)
+    for index in range(4):
+        make_trace(tmp_path, f"{index}.zip", 100, 1000 + index)
+
+    server.prune_traces(str(tmp_path))
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["2.zip", "3.zip"]
+
+
+class FakeTracing:
+    def __init__(self):
+        self.started = False
+        self.stopped_with = []
+
+    async def start(self, **kwargs):
+        self.started = True
+
+    async def stop(self, path=None):
+        self.stopped_with.append(path)
+        if path:
+            with open(path, "wb") as f:
+                f.write(b"trace")
+
+
+class FakeContext:
+    def __init__(self):
+        self.tracing = FakeTracing()
+
+
+@pytest.fixture
+def trace_dir(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "TRACE_DIR", str(tmp_path / "traces"))
+    monkeypatch.setattr(server, "TRACE_ON_ERROR", True)
+    monkeypatch.setattr(server, "TRACE_SAMPLE_RATE", 0)
+    return tmp_path / "traces"
+
+
+def test_trace_kept_on_error(server, trace_dir):
+    context = FakeContext()
+
+    async def scenario():
+        async with server.trace_capture(context, "tool"):
+            raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError, match="boom"):
+        asyncio.run(scenario())
+    assert len(list(trace_dir.glob("*-tool-*.zip"))) == 1
+
+
+def test_trace_discarded_on_success(server, trace_dir):
+    context = FakeContext()
+
+    async def scenario():
+        async with server.trace_capture(context, "tool"):
+            pass
+
+    asyncio.run(scenario())
+    assert context.tracing.started
+    assert context.tracing.stopped_with == [None]
+    assert not trace_dir.exists()
+
+
+def test_unwritable_trace_dir_keeps_original_error(server, tmp_path, monkeypatch):
+    blocker = tmp_path / "file"
+    blocker.write_text("")
+    monkeypatch.setattr(server, "TRACE_DIR", str(blocker / "traces"))
+    monkeypatch.setattr(server, "TRACE_ON_ERROR", True)
+    context = FakeContext()
+
+    async def scenario():
+        async with server.trace_capture(context, "tool"):
+            raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError, match="boom"):
+        asyncio.run(scenario())
+    assert context.tracing.stopped_with == [None]